@@ -10,9 +10,11 @@ from const import MODELS, PromptConfig
 from generations.completion import get_answer_with_context
 from models.enum import RetrievalApiEnum
 from models.types import Chat, Message, RoleEnum, Source
-from postretrieve.rerank import Reranker
-from preretrieve.expansion.langchain.expansion import QueryExpansion
-from preretrieve.hyde import HyDE
+from postretrieve.compression import CONTEXT_COMPRESSION_RATIO, compress_sources
+from postretrieve.rerank import get_reranker
+from postretrieve.window_merge import merge_windows
+from preretrieve.expansion.langchain.expansion import get_query_expansion
+from preretrieve.hyde import get_hyde
 
 from translator import TranslationEngine
 
@@ -20,9 +22,6 @@ from .utilities import ReturnValueThread, StreamHandler
 
 logger = logging.getLogger(__name__)
 
-# Cache it so model don't get loaded again
-reranker = Reranker()
-
 
 class AppController:
     def __init__(self):
@@ -98,7 +97,7 @@ class AppController:
 
                     en_user_query = translator.translateToEn(user_query)
 
-                    queryExpansion = QueryExpansion(with_openAI=True)
+                    queryExpansion = get_query_expansion(with_openAI=True)
 
                     # Default is only user query
                     expanded_queries = [en_user_query]
@@ -109,7 +108,7 @@ class AppController:
                     hyde_passages = expanded_queries
                     if st.session_state.use_hyde:
                         hyde_passages = [
-                            HyDE().run(query) for query in expanded_queries
+                            get_hyde().run(query) for query in expanded_queries
                         ]
 
                     # Only render this if either query expansion or HyDE is enabled.
@@ -143,12 +142,13 @@ class AppController:
             ):
                 with st.spinner("Vui lòng đợi, tôi đang tìm dẫn chứng... :eyes:"):
                     stop_event = threading.Event()
+                    retrieval = RetrievalApiEnum.get_retrieval(
+                        retrieval_type=st.session_state.retrieval_api,
+                        alpha=st.session_state.sparse_dense_weight,
+                        similarity_top_k=st.session_state.similarity_top_k,
+                    )
                     thread = ReturnValueThread(
-                        target=RetrievalApiEnum.get_retrieval(
-                            retrieval_type=st.session_state.retrieval_api,
-                            alpha=st.session_state.sparse_dense_weight,
-                            similarity_top_k=st.session_state.similarity_top_k,
-                        ).search,
+                        target=retrieval.search,
                         args=(hyde_passages,),
                     )
                     add_script_run_ctx(thread)
@@ -164,18 +164,40 @@ class AppController:
 
                 # Post retrieval steps
                 with st.spinner("Tôi đang tổng hợp dữ liệu..."):
+                    # One span per run of overlapping sentence windows.
+                    related_articles = merge_windows(related_articles)
+
                     reranked_articles = []
                     if st.session_state.use_rerank:
                         # Rerank the articles
                         print(f"{en_user_query=}, {related_articles=}")
-                        # TODO: Cache the reranker?
-                        reranked_articles = reranker.get_top_k(
+                        reranked_articles = get_reranker().get_top_k(
                             en_user_query,
                             related_articles,
                             st.session_state.rerank_top_k,
                         )
                         related_articles = reranked_articles
 
+                    # Only the question-relevant sentences go to the LLM.
+                    context_articles = related_articles
+                    if st.session_state.use_compression and len(related_articles) > 0:
+                        try:
+                            compression = compress_sources(
+                                en_user_query,
+                                related_articles,
+                                st.session_state.selected_model,
+                                ratio=st.session_state.compression_ratio,
+                                retrieval=retrieval,
+                            )
+                            context_articles = compression.sources
+                            st.caption(
+                                f"Context compressed to {compression.ratio:.0%}, "
+                                f"{compression.tokens_saved} tokens saved"
+                            )
+                        except Exception:
+                            # The uncompressed sources still answer the question.
+                            logger.exception("Context compression failed")
+
                 with st.spinner("Tôi đang xử lí..."):
                     # Temp chatbox for streaming outputs
                     chat_box = st.markdown("")
@@ -188,10 +210,10 @@ class AppController:
                             args=(
                                 en_user_query,
                                 st.session_state.selected_model,
-                                related_articles,
+                                context_articles,
                                 st.session_state.custom_instruction,
                                 st.session_state.temperature,
-                                # stream_handler,
+                                stream_handler,
                             ),
                         )
                         add_script_run_ctx(thread)
@@ -199,8 +221,15 @@ class AppController:
                         thread.join()
                         stop_event.set()
                         completion_en = thread.result
+                        if stream_handler.time_to_first_token is not None:
+                            st.caption(
+                                f"First token after "
+                                f"{stream_handler.time_to_first_token:.2f}s, "
+                                f"{stream_handler.tokens_per_second or 0.0:.1f} tokens/s"
+                            )
+
+                        # The English answer is already streamed, add its translation.
                         completion_vn = translator.translateToVi(completion_en)
-                        
                         chat_box.write(completion_en + "\n" + completion_vn)
 
                         print(completion_en, completion_vn)
@@ -344,6 +373,22 @@ class AppController:
                 format="%d",
                 key="rerank_top_k",
             )
+
+            # Toggle to keep only the sentences closest to the question
+            _ = st.checkbox(
+                label="Compress context",
+                value=False,
+                key="use_compression",
+            )
+            _ = st.slider(
+                label="Share of context tokens to keep",
+                min_value=0.1,
+                max_value=1.0,
+                value=CONTEXT_COMPRESSION_RATIO,
+                step=0.05,
+                format="%.2f",
+                key="compression_ratio",
+            )
             st.divider()
 
             # Toggle to use query expansion and HyDE
@@ -1,4 +1,6 @@
+import logging
 import threading
+import time
 from uuid import UUID
 
 from langchain.callbacks.base import BaseCallbackHandler
@@ -6,6 +8,8 @@ from langchain_core.outputs import LLMResult
 
 from const import PromptConfig
 
+logger = logging.getLogger(__name__)
+
 
 class ReturnValueThread(threading.Thread):
     def __init__(self, *args, **kwargs):
@@ -17,16 +21,48 @@ class ReturnValueThread(threading.Thread):
 
 
 class StreamHandler(BaseCallbackHandler):
+    """Renders the answer token by token and times the stream.
+
+    `time_to_first_token` is measured from the request to the model, and
+    `tokens_per_second` over the tokens streamed after the first one.
+    """
+
     def __init__(self, container, initial_text="", display_method="markdown"):
         self.container = container
         self.display_text = initial_text
         self.display_method = display_method
         self.text_so_far = ""
 
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.num_tokens = 0
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        if self.started_at is None or self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        if self.first_token_at is None or self.finished_at is None:
+            return None
+        elapsed = self.finished_at - self.first_token_at
+        return (self.num_tokens - 1) / elapsed if elapsed > 0 else None
+
+    def on_llm_start(self, serialized: dict, prompts: list[str], **kwargs) -> None:
+        # Chat models report here too, langchain falls back from on_chat_model_start.
+        self.started_at = time.perf_counter()
+
     def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.num_tokens += 1
         self.text_so_far += token
+        self.render()
 
-        # Render
+    def render(self):
         display_function = getattr(self.container, self.display_method, None)
         if display_function is not None:
             display_function(self.text_so_far)
@@ -41,8 +77,17 @@ class StreamHandler(BaseCallbackHandler):
         parent_run_id: UUID | None = None,
         **kwargs,
     ):
+        self.finished_at = time.perf_counter()
+        if self.time_to_first_token is not None:
+            tokens_per_second = self.tokens_per_second or 0.0
+            logger.info(
+                f"Streamed {self.num_tokens} tokens, time to first token "
+                f"{self.time_to_first_token:.2f}s, {tokens_per_second:.1f} tokens/s"
+            )
+
         # Streamlit does not rerender when the answer finishes, so we need to add the disclaimer here.
-        self.on_llm_new_token(PromptConfig.DISCLAIMER)
+        self.text_so_far += PromptConfig.DISCLAIMER
+        self.render()
         return super().on_llm_end(
             response, run_id=run_id, parent_run_id=parent_run_id, **kwargs
         )
@@ -3,7 +3,10 @@ import logging.config
 
 from config import LOGGING_CONFIG
 from UI.app_controller import AppController
+from warmup import start_warm_up
 
 logging.config.dictConfig(LOGGING_CONFIG)
+# Preload models in the background; no-op on Streamlit reruns.
+start_warm_up()
 
 AppController()
@@ -52,6 +52,7 @@ MODEL_CONTEXT_LENGTH = {
     "gemma:2b-instruct": 8192,
     "gemma:7b-instruct": 8192,
     "gemma:latest": 8192,
+    "gpt-4o-mini": 128000,
     "gpt-3.5-turbo-0125": 16385,
     "gpt-4-0125-preview": 128000,
     "claude-3-opus-20240229": 200000,
@@ -1,13 +1,71 @@
 import os
+import threading
+
+import httpx
 from langchain.schema.output_parser import StrOutputParser
 from langchain_community.chat_models import ChatOpenAI
 from langchain_community.llms.ollama import Ollama
 from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
+
+from const import API_KEY, MAX_OUTPUT, PromptConfig
+from models.types import Source
+from generations.context_packer import (
+    MESSAGE_OVERHEAD_TOKENS,
+    get_token_counter,
+    pack_context,
+)
+
+# Requests in flight per provider, shared by every session of the process.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 2))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+
+_provider_semaphores = {
+    "openai": threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY),
+    "ollama": threading.BoundedSemaphore(OLLAMA_MAX_CONCURRENCY),
+}
+
+_http_client: httpx.Client | None = None
+_models: dict[tuple, ChatOpenAI | Ollama] = {}
+_chains: dict[tuple, Runnable] = {}
+_models_lock = threading.Lock()
+
+
+def get_provider_semaphore(model_name: str) -> threading.BoundedSemaphore:
+    """Hold it around a model call to cap concurrent requests to its provider."""
+    return _provider_semaphores["openai" if "gpt" in model_name else "ollama"]
 
-from const import API_KEY, MAX_OUTPUT, MODEL_CONTEXT_LENGTH, PromptConfig
 
+def get_http_client() -> httpx.Client:
+    # One keep-alive pool for every OpenAI client: connections and their TLS
+    # sessions are reused across requests instead of set up per call.
+    global _http_client
+    with _models_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONCURRENCY,
+                    max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+                    keepalive_expiry=60,
+                ),
+                timeout=LLM_TIMEOUT,
+            )
+        return _http_client
+
+
+def get_model(
+    model_name: str, temperature: float, max_tokens: int | None = MAX_OUTPUT
+) -> ChatOpenAI | Ollama:
+    """Shared client per (model, temperature, max_tokens), built on first use.
+
+    Ollama's langchain client posts with a plain `requests.post`, there is no
+    session to share; it is still built once and capped by its semaphore.
+    """
+    key = (model_name, temperature, max_tokens)
+    if key in _models:
+        return _models[key]
 
-def get_model(model_name: str, temperature: float) -> ChatOpenAI | Ollama:
     if "gpt" in model_name:
         model = ChatOpenAI(
             temperature=temperature,
@@ -15,45 +73,51 @@ def get_model(model_name: str, temperature: float) -> ChatOpenAI | Ollama:
             api_key=API_KEY,
             verbose=True,
             streaming=True,
-            max_tokens=MAX_OUTPUT,
+            max_tokens=max_tokens,
+            http_client=get_http_client(),
         )
     else:
         model = Ollama(
             temperature=temperature,
             model=model_name,
             verbose=True,
-            num_predict=MAX_OUTPUT,
+            num_predict=max_tokens,
             repeat_penalty=1.5,
         )
 
-    return model
+    with _models_lock:
+        return _models.setdefault(key, model)
 
 
-def preprocess_context(model_name: str, prompt: str) -> str:
-    CONTEXT_LENGTH = MODEL_CONTEXT_LENGTH.get(model_name, 8192)
-
-    # Truncate to avoid exceeding the maximum context length:
-    # - Different models have different ways to count token.
-    # - This only approximates it by having 1 tok = 1.8 characters.
-    return prompt[: int((CONTEXT_LENGTH - MAX_OUTPUT) * 1.8)]
+def get_answer_chain(model_name: str, temperature: float) -> Runnable:
+    key = (model_name, temperature)
+    if key not in _chains:
+        chain = get_model(model_name, temperature) | StrOutputParser()
+        with _models_lock:
+            _chains.setdefault(key, chain)
+    return _chains[key]
 
 
 def get_answer_with_context(
     query: str,
     model_name: str,
-    related_articles: str | list[dict],
+    related_articles: str | list[Source | dict],
     custom_instruction: str,
     temperature: float,
-    stream_handler = None
+    stream_handler=None,
 ) -> str:
-    # Initialize models & context length.
-    model = get_model(model_name, temperature)
-
     user_prompt = f"Please answer the following medical question and provide relevant references. Question: {query}"
-    system_prompt = (
-        f"Here are some research papers that might be relevant: \n\n{related_articles}"
+    # Whole passages, best first, within the model's context window.
+    counter = get_token_counter(model_name)
+    context = pack_context(
+        model_name,
+        related_articles,
+        header="Here are some research papers that might be relevant: \n\n",
+        reserved_tokens=counter.count(custom_instruction)
+        + counter.count(user_prompt)
+        + 3 * MESSAGE_OVERHEAD_TOKENS,
     )
-    system_prompt = preprocess_context(model_name, system_prompt)
+    system_prompt = context.text
 
     if "gpt" in model_name:
         # Separates context and personality prompt -> clearer context 4 models.
@@ -70,12 +134,13 @@ def get_answer_with_context(
         ]
 
     # RAW OUTPUT
-    chain = model | StrOutputParser()
+    chain = get_answer_chain(model_name, temperature)
 
-    if stream_handler is not None:
-        answer = chain.invoke(messages, config={"callbacks": [stream_handler]})
-    else:
-        answer = chain.invoke(messages)
+    with get_provider_semaphore(model_name):
+        if stream_handler is not None:
+            answer = chain.invoke(messages, config={"callbacks": [stream_handler]})
+        else:
+            answer = chain.invoke(messages)
 
     # Suffix disclaimer, this saves token and we don't have to prompt it.
     answer += PromptConfig.DISCLAIMER
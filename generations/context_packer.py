@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+from const import MAX_OUTPUT, MODEL_CONTEXT_LENGTH
+from models.types import Source
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_LENGTH = 8192
+# Chat templates add a few tokens around every message.
+MESSAGE_OVERHEAD_TOKENS = 8
+# Used when no tokenizer can be loaded, the ratio preprocess_context assumed.
+FALLBACK_CHARS_PER_TOKEN = 1.8
+# Seconds before a tokenizer that failed to load is tried again.
+TOKENIZER_RETRY_SECONDS = float(os.getenv("TOKENIZER_RETRY_SECONDS", 300))
+
+# Hugging Face tokenizers of the Ollama model families, by name prefix.
+OLLAMA_TOKENIZERS = {
+    "llama3": "NousResearch/Meta-Llama-3-8B-Instruct",
+    "llama2": "NousResearch/Llama-2-7b-chat-hf",
+    "phi3": "microsoft/Phi-3-mini-128k-instruct",
+    "gemma": "unsloth/gemma-7b-it",
+    "mixtral": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+}
+
+
+class TokenCounter:
+    """Counts and truncates text in the tokens of one model.
+
+    `loaded` is False when the tokenizer could not be loaded and the counter
+    estimates from characters instead.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.name = "chars"
+        self.loaded = False
+        self.created_at = time.monotonic()
+        self._encode = None
+        self._decode = None
+        try:
+            self.__load()
+            self.loaded = True
+        except Exception as e:
+            logger.warning(
+                f"No tokenizer for {model_name}, estimating "
+                f"{FALLBACK_CHARS_PER_TOKEN} characters per token: {e}"
+            )
+
+    def __load(self):
+        if "gpt" in self.model_name:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            self.name = f"tiktoken/{encoding.name}"
+            self._encode = encoding.encode_ordinary
+            self._decode = encoding.decode
+            return
+
+        families = [f for f in OLLAMA_TOKENIZERS if self.model_name.startswith(f)]
+        if len(families) == 0:
+            raise KeyError(f"unknown model family, known: {list(OLLAMA_TOKENIZERS)}")
+
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(OLLAMA_TOKENIZERS[families[0]])
+        self.name = OLLAMA_TOKENIZERS[families[0]]
+        self._encode = lambda text: tokenizer.encode(text, add_special_tokens=False)
+        self._decode = tokenizer.decode
+
+    def count(self, text: str) -> int:
+        if self._encode is None:
+            return int(len(text) / FALLBACK_CHARS_PER_TOKEN) + 1
+        return len(self._encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        if self._encode is None:
+            return text[: int(max_tokens * FALLBACK_CHARS_PER_TOKEN)]
+        tokens = self._encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self._decode(tokens[:max_tokens])
+
+
+_token_counters: dict[str, TokenCounter] = {}
+_load_locks: dict[str, threading.Lock] = {}
+_token_counters_lock = threading.Lock()
+
+
+def get_token_counter(model_name: str) -> TokenCounter:
+    """Loaded once per model, tokenizers are slow to build.
+
+    Only the model's own lock is held while loading, so one slow download does
+    not block the other models. A counter that fell back to the character
+    estimate is served until TOKENIZER_RETRY_SECONDS have passed, then the
+    tokenizer is tried again.
+    """
+
+    def usable(counter: TokenCounter | None) -> bool:
+        return counter is not None and (
+            counter.loaded
+            or time.monotonic() - counter.created_at < TOKENIZER_RETRY_SECONDS
+        )
+
+    with _token_counters_lock:
+        counter = _token_counters.get(model_name)
+        if usable(counter):
+            return counter
+        load_lock = _load_locks.setdefault(model_name, threading.Lock())
+
+    # Requests arriving during the retry keep the fallback instead of waiting.
+    if counter is not None and not load_lock.acquire(blocking=False):
+        return counter
+    if counter is None:
+        load_lock.acquire()
+    try:
+        with _token_counters_lock:
+            counter = _token_counters.get(model_name)
+            if usable(counter):
+                return counter
+        counter = TokenCounter(model_name)
+        with _token_counters_lock:
+            _token_counters[model_name] = counter
+        return counter
+    finally:
+        load_lock.release()
+
+
+def format_source(number: int, source: Source) -> str:
+    header = f"[{number}] {source.file_name}, page {source.page}"
+    if source.doi:
+        header += f", doi {source.doi}"
+    return f"{header}\n{source.content.strip()}"
+
+
+@dataclass
+class PackedContext:
+    text: str
+    sources: list[Source] = field(default_factory=list)
+    tokens: int = 0
+    budget: int = 0
+    dropped: int = 0
+
+
+def pack_context(
+    model_name: str,
+    sources: str | list[Source | dict],
+    header: str = "",
+    reserved_tokens: int = 0,
+) -> PackedContext:
+    """Fill the model's context window with whole passages, best score first.
+
+    `reserved_tokens` covers the rest of the prompt (instruction, question) and
+    MAX_OUTPUT is kept free for the answer. A passage that does not fit is
+    skipped rather than cut, so a shorter one further down can still get in.
+    """
+    counter = get_token_counter(model_name)
+    budget = (
+        MODEL_CONTEXT_LENGTH.get(model_name, DEFAULT_CONTEXT_LENGTH)
+        - MAX_OUTPUT
+        - reserved_tokens
+        - counter.count(header)
+    )
+
+    if isinstance(sources, str):
+        # Pre-formatted context, nothing to pack but the budget still holds.
+        text = counter.truncate(sources, budget)
+        return PackedContext(
+            text=header + text, tokens=counter.count(text), budget=budget
+        )
+
+    sources = [
+        source if isinstance(source, Source) else Source(**source) for source in sources
+    ]
+    ranked = sorted(
+        sources,
+        key=lambda source: source.score if source.score is not None else 0.0,
+        reverse=True,
+    )
+
+    passages: list[str] = []
+    packed: list[Source] = []
+    tokens = 0
+    for source in ranked:
+        passage = format_source(len(packed) + 1, source)
+        # The blank line separating passages is about one token.
+        passage_tokens = counter.count(passage) + 1
+        if tokens + passage_tokens > budget:
+            continue
+        passages.append(passage)
+        packed.append(source)
+        tokens += passage_tokens
+
+    logger.info(
+        f"Packed {len(packed)}/{len(sources)} passages into {tokens}/{budget} "
+        f"tokens for {model_name} ({counter.name})"
+    )
+    return PackedContext(
+        text=header + "\n\n".join(passages),
+        sources=packed,
+        tokens=tokens,
+        budget=budget,
+        dropped=len(sources) - len(packed),
+    )
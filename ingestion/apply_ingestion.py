@@ -1,10 +1,12 @@
-from ingestion import ingestion_index
+from ingestion.ingestion import ingestion_index
 
 
 ingestion = ingestion_index
-ingestion.clear_database()
-documents = ingestion.load_documents(k=2)  # smart chunking
-nodes = ingestion.sentence_window_split(documents=documents)
+# Only new, changed or removed PDFs are processed. Call ingestion.clear_database()
+# first to force a full rebuild.
+ingestion.sync_chroma()
+# documents = ingestion.load_documents(k=2)  # smart chunking
+# nodes = ingestion.sentence_window_split(documents=documents)
 # nodes = ingestion.split_documents(documents)
 # nodes = ingestion.extract_metadata(documents=documents)
-ingestion.add_to_chroma(nodes=nodes)
+# ingestion.add_to_chroma(nodes=nodes)
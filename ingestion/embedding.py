@@ -0,0 +1,181 @@
+import logging
+import threading
+from typing import Callable
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from const import API_KEY, EmbeddingConfig
+from ingestion.embedding_cache import EmbeddingCache, embedding_cache
+
+logger = logging.getLogger(__name__)
+
+
+def get_query_embedding_batch(
+    embed_model: BaseEmbedding, queries: list[str]
+) -> list[Embedding]:
+    """Embed several queries with one call to the embedding model.
+
+    The vectors are the same as calling `embed_model.get_query_embedding` on each
+    query, so batched and per-query retrieval return identical results.
+    """
+    if len(queries) == 0:
+        return []
+
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model.get_query_embedding_batch(queries)
+
+    # Compared by class name so the provider packages are only imported on use.
+    if embed_model.class_name() == "HuggingFaceEmbedding":
+        # Same path as `_get_query_embedding`, but for the whole list at once.
+        return embed_model._embed(queries, prompt_name="query")
+
+    if (
+        embed_model.class_name() == "OpenAIEmbedding"
+        and embed_model._query_engine != embed_model._text_engine
+    ):
+        # Older OpenAI models use a dedicated query engine, keep them per query.
+        return [embed_model.get_query_embedding(query) for query in queries]
+
+    # OpenAI (text-embedding-3-*) and Ollama embed queries and texts the same way.
+    return embed_model.get_text_embedding_batch(queries)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model so only texts missing from the cache are embedded."""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _cache_key: str = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache_key: str,
+        cache: EmbeddingCache = embedding_cache,
+    ):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+        # e.g. "openai/text-embedding-3-small", the full EMBEDDING_MODEL_NAME
+        self._cache_key = cache_key
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    def get_query_embedding_batch(self, queries: list[str]) -> list[Embedding]:
+        return self._get_cached(
+            queries,
+            # Some models embed queries differently from passages.
+            cache_key=f"{self._cache_key}#query",
+            embed=lambda texts: get_query_embedding_batch(self._embed_model, texts),
+        )
+
+    def get_text_embedding_batch_with(
+        self, texts: list[str], embed: Callable[[list[str]], list[Embedding]]
+    ) -> list[Embedding]:
+        """Like `get_text_embedding_batch`, but cache misses go through `embed`."""
+        return self._get_cached(texts, cache_key=self._cache_key, embed=embed)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self.get_query_embedding_batch([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return self._get_cached(
+            texts,
+            cache_key=self._cache_key,
+            embed=self._embed_model.get_text_embedding_batch,
+        )
+
+    def _get_cached(
+        self,
+        texts: list[str],
+        cache_key: str,
+        embed: Callable[[list[str]], list[Embedding]],
+    ) -> list[Embedding]:
+        embeddings = self._cache.get_many(cache_key, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            new_embeddings = embed([texts[i] for i in missing])
+            self._cache.put_many(cache_key, [texts[i] for i in missing], new_embeddings)
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
+
+        logger.debug(
+            f"Embedding cache: {len(texts) - len(missing)}/{len(texts)} hits, "
+            f"{self._cache.stats()}"
+        )
+        return embeddings
+
+
+_embed_models: dict[str, CachedEmbedding] = {}
+_embed_models_lock = threading.Lock()
+
+
+def get_embed_model(embedding_model_name: str) -> CachedEmbedding:
+    """Shared, cached embedding model for an EmbeddingConfig-prefixed name.
+
+    Each model is loaded once per process, on first use. Pass the result
+    explicitly to indexes and retrievers instead of setting Settings.embed_model.
+    """
+    if embedding_model_name not in _embed_models:
+        with _embed_models_lock:
+            if embedding_model_name not in _embed_models:
+                logger.info(f"Loading embedding model {embedding_model_name}")
+                _embed_models[embedding_model_name] = CachedEmbedding(
+                    _load_embed_model(embedding_model_name),
+                    cache_key=embedding_model_name,
+                )
+    return _embed_models[embedding_model_name]
+
+
+def _load_embed_model(embedding_model_name: str) -> BaseEmbedding:
+    # Provider packages are imported only for the model actually used; the
+    # HuggingFace one alone pulls in torch and sentence-transformers.
+    if embedding_model_name.startswith(EmbeddingConfig.OPENAI_PREFIX):
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        return OpenAIEmbedding(
+            model=embedding_model_name.replace(EmbeddingConfig.OPENAI_PREFIX, ""),
+            api_key=API_KEY,
+        )
+    elif embedding_model_name.startswith(EmbeddingConfig.HUGGINGFACE_PREFIX):
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        return HuggingFaceEmbedding(
+            model_name=embedding_model_name.replace(
+                EmbeddingConfig.HUGGINGFACE_PREFIX, ""
+            )
+        )
+    elif embedding_model_name.startswith(EmbeddingConfig.OLLAMA_PREFIX):
+        from llama_index.embeddings.ollama import OllamaEmbedding
+
+        return OllamaEmbedding(
+            model_name=embedding_model_name.replace(EmbeddingConfig.OLLAMA_PREFIX, "")
+        )
+    else:
+        raise ValueError(f"Unknown embedding model: {embedding_model_name}")
+
+
+def check_embedding_model(index_model_name: str | None, embedding_model_name: str):
+    """Raise if an index is about to be queried or extended with another model."""
+    if index_model_name is not None and index_model_name != embedding_model_name:
+        raise ValueError(
+            f"Index was built with embedding model {index_model_name}, "
+            f"but {embedding_model_name} is configured. Rebuild the index or set "
+            f"EMBEDDING_MODEL_NAME={index_model_name}."
+        )
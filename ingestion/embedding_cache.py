@@ -0,0 +1,143 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from ingestion.sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 2_000_000))
+# Cache hits refresh their last_used time in batches of this many.
+TOUCH_BATCH_SIZE = 1000
+
+
+class EmbeddingCache(SQLiteStore):
+    """On-disk embedding store keyed by (embedding model name, sha256 of text).
+
+    Least recently used entries are evicted once the cache holds more than
+    `max_entries` embeddings. The row count is read once and kept up to date,
+    and hits refresh last_used in batches, so lookups do not write and inserts
+    do not scan the table.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (model, text_hash)
+        )""",
+        "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)",
+    ]
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+    ):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._count = None
+        # {(model, text hash): last used} not written yet
+        self._touched: dict[tuple[str, str], float] = {}
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        hashes = [self.hash_text(text) for text in texts]
+
+        with self._lock:
+            rows = self.select_in(
+                "SELECT text_hash, embedding FROM embeddings "
+                "WHERE model = ? AND text_hash IN ({})",
+                [model],
+                hashes,
+            )
+            found = {
+                text_hash: np.frombuffer(blob, dtype=np.float64).tolist()
+                for text_hash, blob in rows
+            }
+
+            now = time.time()
+            for text_hash in found:
+                self._touched[(model, text_hash)] = now
+            if len(self._touched) >= TOUCH_BATCH_SIZE:
+                self._flush_touched()
+                self.connection.commit()
+
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+
+        return [found.get(text_hash) for text_hash in hashes]
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]]):
+        now = time.time()
+        rows = [
+            (
+                model,
+                self.hash_text(text),
+                np.asarray(embedding, dtype=np.float64).tobytes(),
+                now,
+            )
+            for text, embedding in zip(texts, embeddings)
+        ]
+
+        with self._lock:
+            if self._count is None:
+                (self._count,) = self.connection.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+            hashes = {row[1] for row in rows}
+            existing = self.select_in(
+                "SELECT text_hash FROM embeddings "
+                "WHERE model = ? AND text_hash IN ({})",
+                [model],
+                list(hashes),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            self._count += len(hashes) - len(existing)
+            self._flush_touched()
+            self._evict()
+            self.connection.commit()
+
+    def _flush_touched(self):
+        # Caller must hold self._lock
+        self.connection.executemany(
+            "UPDATE embeddings SET last_used = MAX(last_used, ?) "
+            "WHERE model = ? AND text_hash = ?",
+            [
+                (last_used, model, text_hash)
+                for (model, text_hash), last_used in self._touched.items()
+            ],
+        )
+        self._touched.clear()
+
+    def _evict(self):
+        # Caller must hold self._lock
+        if self._count <= self.max_entries:
+            return
+
+        logger.info(f"Evicting {self._count - self.max_entries} cached embeddings")
+        cursor = self.connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self._count - self.max_entries,),
+        )
+        self._count -= cursor.rowcount
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache()
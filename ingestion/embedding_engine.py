@@ -0,0 +1,290 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.schema import BaseNode, MetadataMode
+
+from const import EmbeddingConfig
+from ingestion.embedding import CachedEmbedding
+
+logger = logging.getLogger(__name__)
+
+# HuggingFace worker processes, each with its own copy of the model, and the
+# torch threads of each; together they should not exceed the cores.
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", min(4, os.cpu_count() or 1)))
+EMBEDDING_WORKER_THREADS = int(
+    os.getenv(
+        "EMBEDDING_WORKER_THREADS", max(1, (os.cpu_count() or 1) // EMBEDDING_WORKERS)
+    )
+)
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 8))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1_000_000))
+# Upper bound on the (estimated) tokens of one request or forward batch.
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 16_384))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 512))
+# Below this many texts, starting worker processes costs more than it saves.
+EMBEDDING_MULTI_PROCESS_MIN_TEXTS = int(
+    os.getenv("EMBEDDING_MULTI_PROCESS_MIN_TEXTS", 1024)
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text, good enough for batching.
+    return len(text) // 4 + 1
+
+
+def make_batches(
+    texts: Sequence[str], max_tokens: int, max_batch_size: int
+) -> list[list[int]]:
+    """Group text indices into batches of similar length under a token budget.
+
+    Short texts end up in large batches and long texts in small ones, so every
+    batch costs about the same and little is spent on padding.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_tokens = 0
+    for i in order:
+        tokens = estimate_tokens(texts[i])
+        if len(batch) > 0 and (
+            batch_tokens + tokens > max_tokens or len(batch) >= max_batch_size
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class TokenBucket:
+    """Blocks callers so that at most `per_minute` units are taken per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        # A request larger than the whole bucket waits for a full bucket.
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class EmbeddingEngine:
+    """Embeds large numbers of texts with the parallelism that suits the provider.
+
+    - huggingface/: the SentenceTransformer is sharded over `workers` processes
+    - openai/, ollama/: `concurrency` requests in flight, throttled by request
+      and token buckets so we stay under the provider's rate limits
+
+    Texts already in the embedding cache of a `CachedEmbedding` are not embedded
+    again.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        model_name: str | None = None,
+        workers: int = EMBEDDING_WORKERS,
+        worker_threads: int = EMBEDDING_WORKER_THREADS,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        requests_per_minute: int = EMBEDDING_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+        batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+    ):
+        self.embed_model = embed_model
+        self.model_name = model_name or self.__infer_model_name()
+        self.workers = workers
+        self.worker_threads = worker_threads
+        self.concurrency = concurrency
+        self.batch_tokens = batch_tokens
+        self.max_batch_size = max_batch_size
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def base_model(self) -> BaseEmbedding:
+        if isinstance(self.embed_model, CachedEmbedding):
+            return self.embed_model.embed_model
+        return self.embed_model
+
+    def __infer_model_name(self) -> str:
+        # For models built outside the EmbeddingConfig naming, e.g. llama-index
+        # defaults in GraphIngestion.
+        base_model = self.base_model
+        if base_model.class_name() == "HuggingFaceEmbedding":
+            prefix = EmbeddingConfig.HUGGINGFACE_PREFIX
+        elif base_model.class_name() == "OllamaEmbedding":
+            prefix = EmbeddingConfig.OLLAMA_PREFIX
+        else:
+            prefix = EmbeddingConfig.OPENAI_PREFIX
+        return prefix + base_model.model_name
+
+    def embed_nodes(self, nodes: Sequence[BaseNode]) -> Sequence[BaseNode]:
+        """Set `node.embedding` on every node that does not have one yet."""
+        missing = [node for node in nodes if node.embedding is None]
+        if len(missing) == 0:
+            return nodes
+
+        start = time.perf_counter()
+        embeddings = self.embed_texts(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in missing]
+        )
+        for node, embedding in zip(missing, embeddings):
+            node.embedding = embedding
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Embedded {len(missing)} nodes with {self.model_name} in {elapsed:.1f}s "
+            f"({len(missing) / elapsed:.1f} nodes/s)"
+        )
+        return nodes
+
+    def embed_texts(self, texts: list[str]) -> list[Embedding]:
+        if isinstance(self.embed_model, CachedEmbedding):
+            return self.embed_model.get_text_embedding_batch_with(texts, self._embed)
+        return self._embed(texts)
+
+    def _embed(self, texts: list[str]) -> list[Embedding]:
+        if len(texts) == 0:
+            return []
+        if self.model_name.startswith(EmbeddingConfig.HUGGINGFACE_PREFIX):
+            return self._embed_multi_process(texts)
+        return self._embed_concurrent(texts)
+
+    def _embed_multi_process(self, texts: list[str]) -> list[Embedding]:
+        base_model = self.base_model
+        model = base_model._model
+
+        # Sorted by length so every forward batch pads to a similar size.
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_texts = [texts[i] for i in order]
+        average_tokens = sum(map(estimate_tokens, texts)) / len(texts)
+        batch_size = int(
+            max(1, min(self.max_batch_size, self.batch_tokens // average_tokens))
+        )
+
+        if self.workers <= 1 or len(texts) < EMBEDDING_MULTI_PROCESS_MIN_TEXTS:
+            embeddings = model.encode(
+                sorted_texts,
+                batch_size=batch_size,
+                prompt_name="text",
+                normalize_embeddings=base_model.normalize,
+            )
+        else:
+            embeddings = model.encode(
+                sorted_texts,
+                pool=self.__get_pool(),
+                batch_size=batch_size,
+                prompt_name="text",
+                normalize_embeddings=base_model.normalize,
+            )
+
+        result: list[Embedding] = [None] * len(texts)
+        for i, embedding in zip(order, embeddings.tolist()):
+            result[i] = embedding
+        return result
+
+    def __get_pool(self):
+        # Worker processes each load a copy of the model, so they are started
+        # once and reused for every later batch.
+        with self._pool_lock:
+            if self._pool is None:
+                import torch
+
+                if torch.cuda.is_available():
+                    target_devices = None  # one process per GPU
+                else:
+                    target_devices = ["cpu"] * self.workers
+                logger.info(
+                    f"Starting {self.workers} embedding worker processes with "
+                    f"{self.worker_threads} threads each"
+                )
+                model = self.base_model._model
+                # Starting the pool moves the model to the CPU in place, but the
+                # same model also embeds queries in this process.
+                device = model.device
+                # Spawned workers read their torch thread count from the
+                # environment when they import torch.
+                previous = {
+                    name: os.environ.get(name)
+                    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+                }
+                os.environ.update(dict.fromkeys(previous, str(self.worker_threads)))
+                try:
+                    self._pool = model.start_multi_process_pool(
+                        target_devices=target_devices
+                    )
+                finally:
+                    for name, value in previous.items():
+                        if value is None:
+                            os.environ.pop(name, None)
+                        else:
+                            os.environ[name] = value
+                model.to(device)
+                atexit.register(self.close)
+            return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self.base_model._model.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+    def _embed_concurrent(self, texts: list[str]) -> list[Embedding]:
+        base_model = self.base_model
+        batches = make_batches(texts, self.batch_tokens, self.max_batch_size)
+
+        def embed_batch(batch: list[int]) -> list[Embedding]:
+            batch_texts = [texts[i] for i in batch]
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(sum(map(estimate_tokens, batch_texts)))
+            # One request per batch; the client still retries on 429 and 5xx.
+            return base_model._get_text_embeddings(batch_texts)
+
+        result: list[Embedding] = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for batch, embeddings in zip(batches, executor.map(embed_batch, batches)):
+                for i, embedding in zip(batch, embeddings):
+                    result[i] = embedding
+        return result
+
+
+_engines: dict[str, EmbeddingEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_embedding_engine(
+    embed_model: BaseEmbedding, model_name: str | None = None
+) -> EmbeddingEngine:
+    """Shared engine per embedding model, so worker pools and rate limits are too."""
+    key = f"{model_name}:{id(embed_model)}"
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = EmbeddingEngine(embed_model, model_name=model_name)
+        return _engines[key]
@@ -1,9 +1,15 @@
 import faiss
 import glob
+import json
 import logging
 import math
 import os
+import re
 import shutil
+from enum import Enum
+from typing import Iterable, Iterator
+
+import numpy as np
 from llama_index.core import (
     Settings,
     StorageContext,
@@ -16,16 +22,12 @@ from llama_index.core import (
 )
 from llama_index.vector_stores.faiss import FaissVectorStore
 
-from const import EmbeddingConfig
 
 # from ingestion import Ingestion
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llmsherpa.readers import LayoutPDFReader
 from llama_index.core.node_parser import SimpleNodeParser
 from llmsherpa.readers.layout_reader import Block
 from llama_index.core.schema import BaseNode, Document
 from llama_index.core.node_parser import SentenceWindowNodeParser
-from llama_index.embeddings.ollama import OllamaEmbedding
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -46,27 +48,47 @@ from llama_index.core import (
     VectorStoreIndex,
     StorageContext,
 )
+from llama_index.core.vector_stores.simple import DEFAULT_VECTOR_STORE, NAMESPACE_SEP
+from llama_index.core.vector_stores.types import DEFAULT_PERSIST_FNAME
 from llama_index.vector_stores.faiss import FaissVectorStore
 
-from llama_index.embeddings.openai import OpenAIEmbedding
-from const import EmbeddingConfig
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llmsherpa.readers import LayoutPDFReader
+from ingestion.embedding import CachedEmbedding, check_embedding_model, get_embed_model
+from ingestion.embedding_cache import embedding_cache
+from ingestion.embedding_engine import EmbeddingEngine, get_embedding_engine
+from ingestion.manifest import IngestionManifest
+from ingestion.parse_cache import parse_cache
+from ingestion.pdf_parser import PdfParser
+from postretrieve.token_store import pretokenize_nodes
+from postretrieve.window_merge import set_window_positions
+from llmsherpa.readers import Document as LayoutDocument
 from llama_index.core.node_parser import SimpleNodeParser
 from llmsherpa.readers.layout_reader import Block
 from llama_index.core.schema import BaseNode, Document
 from llama_index.core.node_parser import SentenceWindowNodeParser
-from llama_index.embeddings.ollama import OllamaEmbedding
 from dotenv import load_dotenv
 
 load_dotenv()
 
-API_KEY = os.getenv("OPENAI_API_KEY", "")
 EMBEDDING_MODEL_NAME = os.getenv(
     "EMBEDDING_MODEL_NAME", "huggingface/ls-da3m0ns/bge_large_medical"
 )
 logger = logging.getLogger(__name__)
 
+FAISS_INDEX_SPEC = os.getenv("FAISS_INDEX_SPEC", "FLAT")
+FAISS_TRAIN_SAMPLE_SIZE = int(os.getenv("FAISS_TRAIN_SAMPLE_SIZE", 100_000))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", 16))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", 64))
+FAISS_MMAP = os.getenv("FAISS_MMAP", "false").lower() == "true"
+
+
+class FaissIndexSpec(str, Enum):
+    # faiss.index_factory strings, {nlist} and {m} are filled in from the corpus.
+    FLAT = "Flat"
+    IVF_FLAT = "IVF{nlist},Flat"
+    IVF_PQ = "IVF{nlist},PQ{m}"
+    HNSW = "HNSW32"
+    SQ8 = "SQ8"
+
 
 class FaissIngestion:
     LLM_SHERPA_API_URL = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
@@ -77,81 +99,260 @@ class FaissIngestion:
         self,
         embedding_model_name: str,
     ):
-        Settings.embed_model = self.__get_embed_model(embedding_model_name)
+        self.embedding_model_name = embedding_model_name
+        self.pdf_parser = PdfParser(self.LLM_SHERPA_API_URL)
 
-    def __get_embed_model(self, embedding_model_name: str):
-        if embedding_model_name.startswith(EmbeddingConfig.OPENAI_PREFIX):
-            return OpenAIEmbedding(
-                model=embedding_model_name.replace(EmbeddingConfig.OPENAI_PREFIX, ""),
-                api_key=API_KEY,
-            )
-        elif embedding_model_name.startswith(EmbeddingConfig.HUGGINGFACE_PREFIX):
-            HuggingFaceEmbedding(
-                model_name=embedding_model_name.replace(
-                    EmbeddingConfig.HUGGINGFACE_PREFIX, ""
-                )
-            )
-        elif embedding_model_name.startswith(EmbeddingConfig.OLLAMA_PREFIX):
-            return OllamaEmbedding(
-                model_name=embedding_model_name.replace(
-                    EmbeddingConfig.OLLAMA_PREFIX, ""
-                )
+    @property
+    def embed_model(self) -> CachedEmbedding:
+        # Loaded on first use, shared with every index using the same model.
+        return get_embed_model(self.embedding_model_name)
+
+    @property
+    def embedding_engine(self) -> EmbeddingEngine:
+        return get_embedding_engine(self.embed_model, self.embedding_model_name)
+
+    @property
+    def embedding_metadata_path(self) -> str:
+        # Records which embedding model built the index in FAISS_PATH
+        return os.path.join(self.FAISS_PATH, "embedding.json")
+
+    def check_embedding_model(self):
+        if not os.path.exists(self.embedding_metadata_path):
+            logger.warning(
+                f"{self.FAISS_PATH} does not record its embedding model, "
+                f"assuming {self.embedding_model_name}"
             )
-        else:
-            raise ValueError(f"Unknown embedding model: {embedding_model_name}")
+            return
+        with open(self.embedding_metadata_path) as f:
+            index_model_name = json.load(f)["embedding_model"]
+        check_embedding_model(index_model_name, self.embedding_model_name)
+
+    def save_embedding_model(self):
+        with open(self.embedding_metadata_path, "w") as f:
+            json.dump({"embedding_model": self.embedding_model_name}, f)
 
-    def create_index(self, nodes=[]):
+    @property
+    def vector_store_path(self) -> str:
+        # Where StorageContext.persist writes the faiss index
+        return os.path.join(
+            self.FAISS_PATH,
+            f"{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}",
+        )
+
+    def create_index(
+        self,
+        nodes=[],
+        index_spec: str = FAISS_INDEX_SPEC,
+        train_sample_size: int = FAISS_TRAIN_SAMPLE_SIZE,
+    ):
         if len(nodes) == 0:
             print("Nodes cannot be empty")
             return
 
-        faiss_index = faiss.IndexFlatL2(1536)
+        # Embed first: the dimension and the training sample both come from the vectors.
+        self.embedding_engine.embed_nodes(nodes)
+        pretokenize_nodes(nodes)
+        embeddings = np.array([node.embedding for node in nodes], dtype="float32")
+
+        sample_size = min(len(embeddings), train_sample_size)
+        faiss_index = self.build_faiss_index(
+            index_spec,
+            dimension=embeddings.shape[1],
+            num_vectors=len(nodes),
+            num_training=sample_size,
+        )
+        if not faiss_index.is_trained:
+            rng = np.random.default_rng(seed=0)
+            sample = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+            logger.info(f"Training {index_spec} index on {sample_size} vectors")
+            faiss_index.train(sample)
+
         vector_store = FaissVectorStore(faiss_index=faiss_index)
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
         index = VectorStoreIndex(
             nodes=nodes,
             storage_context=storage_context,
+            embed_model=self.embed_model,
             show_progress=True,
         )
         index.storage_context.persist(self.FAISS_PATH)
+        self.save_embedding_model()
+        logger.info(f"Embedding cache: {embedding_cache.stats()}")
         return index
 
-    def load_index(self):
+    def sync_index(self, k=math.inf):
+        # Only parse, split and embed PDFs that are new or changed since the last
+        # run, and drop the nodes of PDFs that were removed from DATA_PATH.
+        manifest = IngestionManifest(self.FAISS_PATH)
+        if os.path.exists(self.vector_store_path):
+            num_nodes = faiss.read_index(
+                self.vector_store_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+            ).ntotal
+            manifest.check_untracked(
+                num_nodes, "Rebuild it: call faiss_instance.clear_database() first."
+            )
+        files = sorted(glob.glob(self.DATA_PATH + "/*.pdf"))
+        changed, removed = manifest.diff(files)
+        if k < len(changed):
+            changed = dict(list(changed.items())[:k])
+        logger.info(f"{len(changed)} new or changed files, {len(removed)} removed")
+
+        new_nodes = []
+        new_node_ids: dict[str, list[str]] = {}
+        for file, documents in self.iter_documents(changed):
+            nodes = self.sentence_window_split(documents=documents)
+            new_node_ids[file] = [node.node_id for node in nodes]
+            new_nodes.extend(nodes)
+
+        # Nodes of changed files are replaced by their new version. Files that
+        # failed to parse are not in new_node_ids and keep their old nodes.
+        stale_node_ids = set(manifest.node_ids([*new_node_ids, *removed]))
+
+        if not os.path.exists(self.vector_store_path):
+            index = self.create_index(nodes=new_nodes)
+        elif len(stale_node_ids) > 0:
+            # FaissVectorStore cannot delete, so rebuild from the remaining nodes.
+            # Their embeddings come from the embedding cache.
+            index = self.load_index(mmap=False)
+            nodes = [
+                node
+                for node_id, node in index.docstore.docs.items()
+                if node_id not in stale_node_ids
+            ]
+            if len(nodes) + len(new_nodes) > 0:
+                index = self.create_index(nodes=nodes + new_nodes)
+            else:
+                # Nothing left to index: drop the old one so its vectors are
+                # not served any more.
+                logger.warning(
+                    f"No nodes left, removing the index in {self.FAISS_PATH}"
+                )
+                self.clear_database()
+                index = None
+        else:
+            index = self.load_index(mmap=False)
+            index.insert_nodes(self.embedding_engine.embed_nodes(new_nodes))
+            pretokenize_nodes(new_nodes)
+            index.storage_context.persist(self.FAISS_PATH)
+
+        # Files are only recorded once the index holding their nodes is written.
+        for file in removed:
+            manifest.remove(file)
+        for file, node_ids in new_node_ids.items():
+            manifest.update(file, changed[file], node_ids)
+        manifest.save()
+        logger.info(
+            f"Synced {len(new_node_ids)} files, parse cache: {parse_cache.stats()}, "
+            f"embedding cache: {embedding_cache.stats()}"
+        )
+        return index
+
+    def build_faiss_index(
+        self, index_spec: str, dimension: int, num_vectors: int, num_training: int
+    ):
+        # PQ trains 2^nbits centroids per sub-quantizer, 256 for the default 8-bit
+        # codes. Below that, compression buys nothing: keep the vectors as they are.
+        if index_spec == FaissIndexSpec.IVF_PQ.name and num_training < 256:
+            logger.warning(
+                f"IVF_PQ needs 256 training vectors, got {num_training}; using IVF_FLAT"
+            )
+            index_spec = FaissIndexSpec.IVF_FLAT.name
+
+        # Either a FaissIndexSpec name (e.g. "IVF_PQ") or a raw faiss factory string.
+        if index_spec in FaissIndexSpec.__members__:
+            index_spec = FaissIndexSpec[index_spec].value
+
+        # Rule of thumb from the faiss wiki: ~4 * sqrt(n) lists, with at least
+        # 39 training vectors per list. Training only sees the sample.
+        nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_training // 39))
+        pq_m = next((m for m in (64, 48, 32, 16, 8) if dimension % m == 0), 1)
+        factory_string = index_spec.format(nlist=nlist, m=pq_m)
+
+        # Raw factory strings are taken as given, fail before training instead
+        # of inside faiss' clustering.
+        for match in re.finditer(r"(?<![A-Z])PQ(\d+)(?:x(\d+))?", factory_string):
+            nbits = int(match.group(2) or 8)
+            if num_training < 2**nbits:
+                raise ValueError(
+                    f"faiss index {factory_string} needs at least {2**nbits} "
+                    f"training vectors for {nbits}-bit PQ codes, got {num_training}. "
+                    f"Use FAISS_INDEX_SPEC=FLAT or IVF_FLAT for a corpus this small."
+                )
+
+        logger.info(f"Creating faiss index {factory_string} with {dimension=}")
+        return faiss.index_factory(dimension, factory_string)
+
+    def load_index(
+        self,
+        mmap: bool = FAISS_MMAP,
+        nprobe: int = FAISS_NPROBE,
+        ef_search: int = FAISS_EF_SEARCH,
+    ):
         print("Loading index")
-        vector_store = FaissVectorStore.from_persist_dir(self.FAISS_PATH)
+        self.check_embedding_model()
+        # Memory-mapped indexes stay on disk and are paged in on demand.
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        faiss_index = faiss.read_index(self.vector_store_path, io_flags)
+        self.set_search_params(faiss_index, nprobe=nprobe, ef_search=ef_search)
+
+        vector_store = FaissVectorStore(faiss_index=faiss_index)
         storage_context = StorageContext.from_defaults(
             vector_store=vector_store, persist_dir=self.FAISS_PATH
         )
-        index = load_index_from_storage(storage_context=storage_context)
+        index = load_index_from_storage(
+            storage_context=storage_context, embed_model=self.embed_model
+        )
         return index
 
+    def set_search_params(self, faiss_index, nprobe: int, ef_search: int):
+        # nprobe only exists on IVF indexes and efSearch only on HNSW ones.
+        parameter_space = faiss.ParameterSpace()
+        for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+            try:
+                parameter_space.set_index_parameter(faiss_index, name, value)
+            except RuntimeError:
+                pass
+
     def clear_database(self):
         if os.path.exists(self.FAISS_PATH):
             shutil.rmtree(self.FAISS_PATH)
 
     def load_documents(self, k=math.inf):
-        pdf_reader = LayoutPDFReader(self.LLM_SHERPA_API_URL)
+        files = glob.glob(self.DATA_PATH + "/*.pdf")
+        if k != math.inf:
+            files = files[:k]
+
         documents = []
-        i = 0
-        for file in glob.glob(self.DATA_PATH + "/*.pdf"):
-            if i >= k:
-                break
-            i += 1
-            logger.info(f"{file=}, {i=}")
-            doc = pdf_reader.read_pdf(file)
-            block: Block
-            for block in doc.chunks():
-                metadata = {
-                    "page": block.page_idx,
-                    "file_name": os.path.basename(file),
-                    "tag": block.tag,
-                }
-                document = Document(text=block.to_context_text(), metadata=metadata)
-                documents.append(document)
+        for _, file_documents in self.iter_documents(files):
+            documents.extend(file_documents)
         # self.print_documents(documents)
         return documents
 
+    def iter_documents(
+        self, files: Iterable[str]
+    ) -> Iterator[tuple[str, list[Document]]]:
+        # Parsed concurrently, yielded as soon as each file is done.
+        for i, (file, doc) in enumerate(self.pdf_parser.read_pdfs(files)):
+            logger.info(f"{file=}, {i=}")
+            yield file, self.to_documents(file, doc)
+
+    def load_file(self, file: str) -> list[Document]:
+        return self.to_documents(file, self.pdf_parser.read_pdf(file))
+
+    def to_documents(self, file: str, doc: LayoutDocument) -> list[Document]:
+        documents = []
+        block: Block
+        for block in doc.chunks():
+            metadata = {
+                "page": block.page_idx,
+                "file_name": os.path.basename(file),
+                "tag": block.tag,
+            }
+            document = Document(text=block.to_context_text(), metadata=metadata)
+            documents.append(document)
+        return documents
+
     def split_documents(self, documents: list[Document]):
         node_parser = SimpleNodeParser.from_defaults(chunk_size=1024)
         # Extract nodes from documents
@@ -167,6 +368,7 @@ class FaissIngestion:
             original_text_metadata_key="original_text",
         )
         nodes = node_parser.get_nodes_from_documents(documents)
+        set_window_positions(nodes, window_size=3)
         return nodes
 
     def clear_database(self):
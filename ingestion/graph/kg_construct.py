@@ -3,9 +3,9 @@ import glob
 from langchain_experimental.graph_transformers import LLMGraphTransformer
 from langchain_openai import ChatOpenAI
 from langchain_community.graphs import Neo4jGraph
-from llmsherpa.readers import LayoutPDFReader
 from llmsherpa.readers.layout_reader import Block
 from langchain_core.documents import Document
+from ingestion.pdf_parser import PdfParser
 
 from typing import List
 import logging
@@ -60,11 +60,11 @@ class KGConstruct:
 
     def process(self):
         # use llm sherpa to read pdf
-        pdf_reader = LayoutPDFReader(LLM_SHERPA_API_URL)
+        pdf_parser = PdfParser(LLM_SHERPA_API_URL)
         documents = []
 
-        for file in glob.glob(DATA_PATH):
-            doc = pdf_reader.read_pdf(file)
+        # parse the next files while the graph transformer works on this one
+        for file, doc in pdf_parser.read_pdfs(glob.glob(DATA_PATH)):
             block: Block
             logger.info(f"Processing file: {os.path.basename(file)}")
 
@@ -4,16 +4,22 @@ import os
 import sys
 
 from llama_index.core import Settings, StorageContext, VectorStoreIndex
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.schema import Document
 from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
-from llmsherpa.readers import LayoutPDFReader
 from llmsherpa.readers.layout_reader import Block
 
+from ingestion.embedding import get_embed_model
+from ingestion.embedding_engine import get_embedding_engine
+from ingestion.pdf_parser import PdfParser
+
 
 class GraphIngestion:
     DEFAULT_EMBEDDING_DIMENSION = 1536
     LLM_SHERPA_API_URL = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
     DATA_PATH = "pdf/*.pdf"
+    # llama-index's default embedder, which the 1536-dim neo4j index was built with
+    DEFAULT_EMBEDDING_MODEL_NAME = "openai/text-embedding-ada-002"
 
     def __init__(self, model=None, embedding_model=None, logging_level=logging.INFO):
         # cfg
@@ -23,10 +29,17 @@ class GraphIngestion:
         self.vector_store = None
         self.index = None
 
+        self._embed_model = embedding_model
+
         # If not set, default is OpenAI's GPT-3.5
-        if model is not None and embedding_model is not None:
+        if model is not None:
             Settings.llm = model
-            Settings.embed_model = embedding_model
+
+    @property
+    def embed_model(self):
+        if self._embed_model is None:
+            self._embed_model = get_embed_model(self.DEFAULT_EMBEDDING_MODEL_NAME)
+        return self._embed_model
 
     def init_graph_db(
         self,
@@ -57,18 +70,14 @@ class GraphIngestion:
 
     def process_ingestion(self, data_path=DATA_PATH, k=100, show_progress=True):
         # use llm sherpa to read pdf
-        pdf_reader = LayoutPDFReader(self.LLM_SHERPA_API_URL)
+        pdf_parser = PdfParser(self.LLM_SHERPA_API_URL)
         documents = []
 
-        # iterate through all pdf files in data path
-        file_count = 0
-        for file in glob.glob(self.DATA_PATH):
-            # limit number of files to ingest
-            if file_count >= k:
-                break
-            file_count += 1
+        # limit number of files to ingest
+        files = glob.glob(self.DATA_PATH)[:k]
 
-            doc = pdf_reader.read_pdf(file)
+        # files are parsed concurrently and handled as soon as each one is done
+        for file, doc in pdf_parser.read_pdfs(files):
             block: Block
             for block in doc.chunks():
                 metadata = {
@@ -89,16 +98,25 @@ class GraphIngestion:
         # load storage context using initialized vector store
         storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
 
-        index = VectorStoreIndex.from_documents(
-            documents,
+        # Chunk like VectorStoreIndex.from_documents, but embed through the
+        # parallel engine; the index then skips nodes that have an embedding.
+        nodes = run_transformations(
+            documents, Settings.transformations, show_progress=show_progress
+        )
+        get_embedding_engine(self.embed_model).embed_nodes(nodes)
+        index = VectorStoreIndex(
+            nodes=nodes,
             storage_context=storage_context,
+            embed_model=self.embed_model,
             show_progress=show_progress,
         )
 
         return index
 
     def get_latest_index(self):
-        return VectorStoreIndex.from_vector_store(self.vector_store)
+        return VectorStoreIndex.from_vector_store(
+            self.vector_store, embed_model=self.embed_model
+        )
 
     def get_latest_index(
         self,
@@ -120,7 +138,9 @@ class GraphIngestion:
             hybrid_search=hybrid_search,
         )
 
-        return VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        return VectorStoreIndex.from_vector_store(
+            vector_store=vector_store, embed_model=self.embed_model
+        )
 
 
 if __name__ == "__main__":
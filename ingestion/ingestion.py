@@ -3,7 +3,8 @@ import logging
 import math
 import os
 import shutil
-from typing import List, Sequence
+import time
+from typing import Iterable, Iterator, List, Sequence
 
 import chromadb
 
@@ -12,40 +13,35 @@ from llama_index.core.node_parser import SimpleNodeParser
 from llama_index.core.schema import BaseNode, Document
 from llama_index.core import VectorStoreIndex, StorageContext
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core.node_parser import SentenceWindowNodeParser
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
-from langchain.schema import Document as LangChainDocument
-
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.extractors.entity import EntityExtractor
+from llama_index.core.ingestion import IngestionPipeline, run_transformations
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.core import (
     Settings,
     StorageContext,
     VectorStoreIndex,
 )
-from llama_index.core.extractors import (
-    KeywordExtractor,
-)
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.node_parser import SimpleNodeParser
 from llama_index.core.schema import BaseNode, Document
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.extractors.entity import EntityExtractor
-from llama_index.llms.ollama import Ollama
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llmsherpa.readers import LayoutPDFReader
+from llmsherpa.readers import Document as LayoutDocument
 from llmsherpa.readers.layout_reader import Block
 
-from langchain_community.document_loaders.llmsherpa import LLMSherpaFileLoader
-
 from dotenv import load_dotenv
 
-from const import EmbeddingConfig
+from ingestion.embedding import CachedEmbedding, check_embedding_model, get_embed_model
+from ingestion.embedding_cache import embedding_cache
+from ingestion.parse_cache import parse_cache
+from ingestion.embedding_engine import EmbeddingEngine, get_embedding_engine
+from ingestion.manifest import IngestionManifest
+from ingestion.pdf_parser import PdfParser
+from postretrieve.token_store import pretokenize_nodes
+from postretrieve.window_merge import set_window_positions
 
 load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY", "")
 EMBEDDING_MODEL_NAME = os.getenv(
     "EMBEDDING_MODEL_NAME", "huggingface/ls-da3m0ns/bge_large_medical"
 )
@@ -57,57 +53,55 @@ class Ingestion:
     CHROMA_PATH = "chroma"
     # LLM_SHERPA_API_URL = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
     LLM_SHERPA_API_URL = "http://localhost:5010/api/parseDocument?renderFormat=all"
+    EMBEDDING_MODEL_METADATA_KEY = "embedding_model"
 
     def __init__(
         self,
         embedding_model_name: str,
     ):
-        Settings.embed_model = self.__get_embed_model(embedding_model_name)
+        self.embedding_model_name = embedding_model_name
+        self.pdf_parser = PdfParser(
+            self.LLM_SHERPA_API_URL + "&useNewIndentParser=true&applyOcr=yes"
+        )
 
-    def __get_embed_model(self, embedding_model_name: str):
-        if embedding_model_name.startswith(EmbeddingConfig.OPENAI_PREFIX):
-            return OpenAIEmbedding(
-                model=embedding_model_name.replace(EmbeddingConfig.OPENAI_PREFIX, ""),
-                api_key=API_KEY,
-            )
-        elif embedding_model_name.startswith(EmbeddingConfig.HUGGINGFACE_PREFIX):
-            return HuggingFaceEmbedding(
-                model_name=embedding_model_name.replace(
-                    EmbeddingConfig.HUGGINGFACE_PREFIX, ""
-                )
-            )
-        elif embedding_model_name.startswith(EmbeddingConfig.OLLAMA_PREFIX):
-            return OllamaEmbedding(
-                model_name=embedding_model_name.replace(
-                    EmbeddingConfig.OLLAMA_PREFIX, ""
+    @property
+    def embed_model(self) -> CachedEmbedding:
+        # Loaded on first use, shared with every index using the same model.
+        return get_embed_model(self.embedding_model_name)
+
+    @property
+    def embedding_engine(self) -> EmbeddingEngine:
+        return get_embedding_engine(self.embed_model, self.embedding_model_name)
+
+    def get_chroma_client(self) -> chromadb.ClientAPI:
+        return chromadb.PersistentClient(path=self.CHROMA_PATH)
+
+    def get_collection(self, db_name: str = "default_db") -> chromadb.Collection:
+        chroma_collection = self.get_chroma_client().get_or_create_collection(db_name)
+
+        # The collection records the model that embedded it, so queries and
+        # later ingestion runs cannot silently mix embedding spaces.
+        metadata = chroma_collection.metadata or {}
+        index_model_name = metadata.get(self.EMBEDDING_MODEL_METADATA_KEY)
+        check_embedding_model(index_model_name, self.embedding_model_name)
+        if index_model_name is None:
+            if chroma_collection.count() > 0:
+                logger.warning(
+                    f"Collection {db_name} does not record its embedding model, "
+                    f"assuming {self.embedding_model_name}"
                 )
+            chroma_collection.modify(
+                metadata={
+                    **metadata,
+                    self.EMBEDDING_MODEL_METADATA_KEY: self.embedding_model_name,
+                }
             )
-        else:
-            raise ValueError(f"Unknown embedding model: {embedding_model_name}")
+        return chroma_collection
 
     def load_documents(self, k=math.inf):
-        # pdf_reader = LayoutPDFReader(self.LLM_SHERPA_API_URL)
         documents = []
-        i = 0
-        for file in glob.glob(self.DATA_PATH + "/*.pdf"):
-            print(file)
-            if i >= k:
-                break
-            i += 1
-            logger.info(f"{file=}, {i=}")
-            loader = LLMSherpaFileLoader(
-                file_path=file,
-                new_indent_parser=True,
-                apply_ocr=True,
-                strategy="chunks",
-                llmsherpa_api_url="http://localhost:5010/api/parseDocument?renderFormat=all",
-            )
-            docs: List[LangChainDocument] = loader.load()
-            # doc = pdf_reader.read_pdf(file)
-
-            for doc in docs:
-                document = Document(text=doc.page_content, metadata=doc.metadata)
-                documents.append(document)
+        for _, file_documents in self.iter_documents(self.__list_files(k)):
+            documents.extend(file_documents)
 
             # block: Block
             # for block in doc.chunks():
@@ -121,7 +115,40 @@ class Ingestion:
         # self.print_documents(documents)
         return documents
 
+    def iter_documents(
+        self, files: Iterable[str]
+    ) -> Iterator[tuple[str, list[Document]]]:
+        # Parsed concurrently, yielded as soon as each file is done.
+        for i, (file, doc) in enumerate(self.pdf_parser.read_pdfs(files)):
+            logger.info(f"{file=}, {i=}")
+            yield file, self.__to_documents(file, doc)
+
+    def load_file(self, file: str) -> list[Document]:
+        return self.__to_documents(file, self.pdf_parser.read_pdf(file))
+
+    def __to_documents(self, file: str, doc: LayoutDocument) -> list[Document]:
+        # Same documents as LLMSherpaFileLoader(strategy="chunks").load()
+        return [
+            Document(
+                text=chunk.to_context_text(),
+                metadata={
+                    "source": file,
+                    "chunk_number": chunk_number,
+                    "chunk_type": chunk.tag,
+                },
+            )
+            for chunk_number, chunk in enumerate(doc.chunks())
+        ]
+
+    def __list_files(self, k=math.inf) -> list[str]:
+        files = glob.glob(self.DATA_PATH + "/*.pdf")
+        return files if k == math.inf else files[:k]
+
     def extract_metadata(self, documents: list[Document]):
+        # EntityExtractor loads a span-marker model, only import it when used.
+        from llama_index.core.extractors import KeywordExtractor
+        from llama_index.extractors.entity import EntityExtractor
+
         transformations = [
             # TitleExtractor(),
             # QuestionsAnsweredExtractor(),
@@ -148,6 +175,7 @@ class Ingestion:
             original_text_metadata_key="original_text",
         )
         nodes = node_parser.get_nodes_from_documents(documents)
+        set_window_positions(nodes, window_size=3)
         return nodes
 
     def add_to_chroma(
@@ -156,25 +184,111 @@ class Ingestion:
         nodes: Sequence[BaseNode] = [],
         documents: list[Document] = [],
     ):
-        db = chromadb.PersistentClient(path=self.CHROMA_PATH)
-        chroma_collection = db.get_or_create_collection(db_name)
+        chroma_collection = self.get_collection(db_name)
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        index = VectorStoreIndex(
-            nodes=nodes,
-            storage_context=storage_context,
-            show_progress=True,
+
+        start = time.perf_counter()
+        nodes = list(nodes)
+        if len(documents) > 0:
+            # Same chunking `index.insert(document)` applies, for all documents at once.
+            nodes.extend(run_transformations(documents, Settings.transformations))
+
+        # Embed and write one Chroma-sized batch at a time.
+        batch_size = self.get_chroma_client().get_max_batch_size()
+        for batch_start in range(0, len(nodes), batch_size):
+            batch = nodes[batch_start : batch_start + batch_size]
+            self.embedding_engine.embed_nodes(batch)
+            pretokenize_nodes(batch)
+            self.upsert_nodes(chroma_collection, batch, batch_size=batch_size)
+
+        index = VectorStoreIndex.from_vector_store(
+            vector_store, embed_model=self.embed_model, storage_context=storage_context
         )
-        for document in documents:
-            index.insert(document)
         index.storage_context.persist(self.CHROMA_PATH)
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Upserted {len(nodes)} nodes in {elapsed:.1f}s "
+            f"({len(nodes) / elapsed:.1f} nodes/s), "
+            f"embedding cache: {embedding_cache.stats()}"
+        )
         return index
 
+    def upsert_nodes(
+        self,
+        chroma_collection: chromadb.Collection,
+        nodes: Sequence[BaseNode],
+        batch_size: int,
+    ):
+        # Same records ChromaVectorStore.add writes, but with `upsert`, so
+        # re-ingesting a node replaces it instead of failing on a duplicate id.
+        for batch_start in range(0, len(nodes), batch_size):
+            batch = nodes[batch_start : batch_start + batch_size]
+            metadatas = []
+            for node in batch:
+                metadata = node_to_metadata_dict(
+                    node, remove_text=True, flat_metadata=True
+                )
+                metadatas.append(
+                    {
+                        key: "" if value is None else value
+                        for key, value in metadata.items()
+                    }
+                )
+
+            chroma_collection.upsert(
+                ids=[node.node_id for node in batch],
+                embeddings=[node.get_embedding() for node in batch],
+                metadatas=metadatas,
+                documents=[
+                    node.get_content(metadata_mode=MetadataMode.NONE) for node in batch
+                ],
+            )
+
+    def delete_nodes(self, chroma_collection: chromadb.Collection, node_ids: list[str]):
+        for start in range(0, len(node_ids), 5000):
+            chroma_collection.delete(ids=node_ids[start : start + 5000])
+
+    def sync_chroma(self, db_name: str = "default_db", k=math.inf, **kwargs):
+        # Only parse, split and embed PDFs that are new or changed since the last
+        # run, and drop the nodes of PDFs that were removed from DATA_PATH.
+        from ingestion.pipeline import StreamingIngestion
+
+        manifest = IngestionManifest(self.CHROMA_PATH)
+        chroma_collection = self.get_collection(db_name)
+        manifest.check_untracked(
+            chroma_collection.count(),
+            "Rebuild it with `python3 -m ingestion.pipeline --rebuild`.",
+        )
+        files = sorted(glob.glob(self.DATA_PATH + "/*.pdf"))
+        changed, removed = manifest.diff(files)
+        if k < len(changed):
+            changed = dict(list(changed.items())[:k])
+        logger.info(f"{len(changed)} new or changed files, {len(removed)} removed")
+
+        # Old nodes of changed files are replaced once their new nodes are
+        # written, see StreamingIngestion.run, so a file that fails to parse
+        # keeps its previous version.
+        self.delete_nodes(chroma_collection, manifest.node_ids(removed))
+        for file in removed:
+            manifest.remove(file)
+        manifest.save()
+
+        # Streamed in bounded batches, see StreamingIngestion for the kwargs.
+        pipeline = StreamingIngestion(self, db_name=db_name, **kwargs)
+        num_nodes = pipeline.run(changed, manifest)
+        logger.info(
+            f"Ingested {num_nodes} nodes, parse cache: {parse_cache.stats()}, "
+            f"embedding cache: {embedding_cache.stats()}"
+        )
+
     def read_from_chroma(self, db_name: str = "default_db"):
-        db = chromadb.PersistentClient(path=self.CHROMA_PATH)
-        chroma_collection = db.get_or_create_collection(db_name)
+        chroma_collection = self.get_collection(db_name)
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store)
+        index = VectorStoreIndex.from_vector_store(
+            vector_store, embed_model=self.embed_model
+        )
         return index
 
         # db = chromadb.PersistentClient(path=self.CHROMA_PATH)
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+
+
+class IngestionManifest:
+    """Content hash and produced node ids of every ingested source file.
+
+    Stored next to the vector store it describes, so clearing the database also
+    clears the manifest.
+    """
+
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.files: dict[str, dict] = {}
+        self.exists = os.path.exists(self.path)
+        if self.exists:
+            with open(self.path) as f:
+                self.files = json.load(f)
+
+    @staticmethod
+    def hash_file(file: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def diff(self, files: list[str]) -> tuple[dict[str, str], list[str]]:
+        """Return ({file: hash} of new or changed files, list of removed files)."""
+        changed = {}
+        for file in files:
+            file_hash = self.hash_file(file)
+            if self.files.get(file, {}).get("hash") != file_hash:
+                changed[file] = file_hash
+
+        current = set(files)
+        removed = [file for file in self.files if file not in current]
+        return changed, removed
+
+    def check_untracked(self, num_nodes: int, rebuild_hint: str):
+        """Raise if the store holds nodes but no manifest describes them.
+
+        Stores built before manifests were kept would otherwise get every file
+        ingested again next to its old nodes.
+        """
+        if not self.exists and num_nodes > 0:
+            raise ValueError(
+                f"{self.path} is missing but the store already holds {num_nodes} "
+                f"nodes, syncing would duplicate them. {rebuild_hint}"
+            )
+
+    def node_ids(self, files: list[str]) -> list[str]:
+        return [
+            node_id
+            for file in files
+            for node_id in self.files.get(file, {}).get("node_ids", [])
+        ]
+
+    def update(self, file: str, file_hash: str, node_ids: list[str]):
+        self.files[file] = {"hash": file_hash, "node_ids": node_ids}
+
+    def remove(self, file: str):
+        self.files.pop(file, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Write then rename so an interrupted run never leaves a truncated manifest.
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.files, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH", "parse_cache")
+
+
+class ParseCache:
+    """Raw LLMSherpa layout blocks on disk, keyed by PDF content and parser options.
+
+    The parser options are the parse URL (render format, indent parser, OCR...),
+    so changing them parses the file again instead of reusing stale blocks.
+    """
+
+    def __init__(self, directory: str = PARSE_CACHE_PATH):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        # Parser worker threads share one cache.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(pdf_bytes: bytes, options: str) -> str:
+        sha256 = hashlib.sha256(pdf_bytes)
+        sha256.update(b"\0" + options.encode("utf-8"))
+        return sha256.hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Two-level fan-out keeps directories small for large corpora.
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> list[dict] | None:
+        path = self._path(key)
+        blocks = None
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    blocks = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Ignoring unreadable parse cache entry {path}")
+
+        with self._lock:
+            if blocks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return blocks
+
+    def put(self, key: str, blocks: list[dict]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent workers never read a partial file.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(blocks, f)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else 0.0,
+        }
+
+
+parse_cache = ParseCache()
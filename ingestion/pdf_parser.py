@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator
+
+import requests
+from llmsherpa.readers import Document as LayoutDocument
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ingestion.parse_cache import ParseCache, parse_cache
+
+logger = logging.getLogger(__name__)
+
+PDF_PARSE_MAX_WORKERS = int(os.getenv("PDF_PARSE_MAX_WORKERS", 4))
+PDF_PARSE_RETRIES = int(os.getenv("PDF_PARSE_RETRIES", 3))
+PDF_PARSE_TIMEOUT = float(os.getenv("PDF_PARSE_TIMEOUT", 300))
+
+
+class PdfParser:
+    """Sends PDFs to an LLMSherpa parse endpoint, several at a time.
+
+    Drop-in for `LayoutPDFReader.read_pdf`, plus `read_pdfs` which parses many
+    files with at most `max_workers` requests in flight and yields them in the
+    order they finish. Parse results are cached on disk, so re-ingesting an
+    unchanged file with the same options makes no network call.
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        max_workers: int = PDF_PARSE_MAX_WORKERS,
+        retries: int = PDF_PARSE_RETRIES,
+        backoff_factor: float = 1.0,
+        timeout: float = PDF_PARSE_TIMEOUT,
+        cache: ParseCache | None = parse_cache,
+    ):
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.cache = cache
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        # One pooled keep-alive session per worker thread.
+        if not hasattr(self._local, "session"):
+            retry = Retry(
+                total=self.retries,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None,  # parse requests are POSTs
+            )
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(max_retries=retry))
+            session.mount("https://", HTTPAdapter(max_retries=retry))
+            self._local.session = session
+        return self._local.session
+
+    def parse_blocks(self, file: str) -> list[dict]:
+        start = time.perf_counter()
+        with open(file, "rb") as f:
+            pdf_bytes = f.read()
+
+        if self.cache is not None:
+            key = self.cache.make_key(pdf_bytes, options=self.api_url)
+            blocks = self.cache.get(key)
+            if blocks is not None:
+                logger.debug(f"Loaded cached parse of {file}")
+                return blocks
+
+        pdf_file = (os.path.basename(file), pdf_bytes, "application/pdf")
+        response = self.session.post(
+            self.api_url, files={"file": pdf_file}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        blocks = response.json()["return_dict"]["result"]["blocks"]
+        if self.cache is not None:
+            self.cache.put(key, blocks)
+
+        logger.info(f"Parsed {file} in {time.perf_counter() - start:.2f}s")
+        return blocks
+
+    def read_pdf(self, file: str) -> LayoutDocument:
+        return LayoutDocument(self.parse_blocks(file))
+
+    def read_pdfs(self, files: Iterable[str]) -> Iterator[tuple[str, LayoutDocument]]:
+        # Files that still fail after the retries are logged and skipped.
+        files = iter(files)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        pending: dict[Future, str] = {}
+
+        def submit_next():
+            file = next(files, None)
+            if file is not None:
+                pending[executor.submit(self.read_pdf, file)] = file
+
+        try:
+            # Keep a few files queued per worker, but not the whole corpus.
+            for _ in range(self.max_workers * 2):
+                submit_next()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file = pending.pop(future)
+                    submit_next()
+                    try:
+                        document = future.result()
+                    except Exception:
+                        logger.exception(f"Failed to parse {file}")
+                        continue
+                    yield file, document
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,197 @@
+import argparse
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, TypeVar
+
+from llama_index.core.schema import BaseNode
+
+from ingestion.ingestion import Ingestion, ingestion_index
+from ingestion.manifest import IngestionManifest
+from postretrieve.token_store import pretokenize_nodes
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", 256))
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", 4))
+
+
+@dataclass
+class NodeBatch:
+    nodes: list[BaseNode]
+    # {file: (file hash, node ids)} of files whose last node is in this batch
+    completed_files: dict[str, tuple[str, list[str]]] = field(default_factory=dict)
+
+
+def prefetch(iterable: Iterable[T], maxsize: int) -> Iterator[T]:
+    """Run `iterable` in a background thread, at most `maxsize` items ahead.
+
+    The bounded queue is the backpressure between two stages: a fast producer
+    blocks once the consumer falls `maxsize` items behind.
+    """
+    items: queue.Queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Also reached when the consumer stops early, so the producer exits too.
+        stop.set()
+        thread.join()
+
+
+class StreamingIngestion:
+    """Parse -> split -> embed -> upsert, one bounded batch of nodes at a time.
+
+    Every stage runs in its own thread and hands over at most `queue_size`
+    batches, so memory stays flat regardless of how many PDFs are ingested.
+    The manifest is saved after each upsert, so an interrupted run resumes
+    where it stopped. The previous nodes of a changed file are deleted only
+    once all its new nodes are written; files that fail to parse keep theirs.
+    """
+
+    def __init__(
+        self,
+        ingestion: Ingestion,
+        db_name: str = "default_db",
+        batch_size: int = INGESTION_BATCH_SIZE,
+        queue_size: int = INGESTION_QUEUE_SIZE,
+    ):
+        self.ingestion = ingestion
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    def run(self, files: dict[str, str], manifest: IngestionManifest) -> int:
+        """Ingest {file: file hash} into Chroma and record them in `manifest`."""
+        chroma_collection = self.ingestion.get_collection(self.db_name)
+        # Largest write the Chroma backend accepts in one call.
+        upsert_batch_size = self.ingestion.get_chroma_client().get_max_batch_size()
+
+        start = time.perf_counter()
+        num_nodes = 0
+        batches = prefetch(self.iter_batches(files), self.queue_size)
+        embedded = prefetch(map(self.embed_batch, batches), self.queue_size)
+        for batch in embedded:
+            self.ingestion.upsert_nodes(
+                chroma_collection, batch.nodes, batch_size=upsert_batch_size
+            )
+            num_nodes += len(batch.nodes)
+
+            for file, (file_hash, node_ids) in batch.completed_files.items():
+                stale_node_ids = set(manifest.node_ids([file])) - set(node_ids)
+                self.ingestion.delete_nodes(chroma_collection, list(stale_node_ids))
+                manifest.update(file, file_hash, node_ids)
+            manifest.save()
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Upserted {num_nodes} nodes ({num_nodes / elapsed:.1f} nodes/s)"
+            )
+
+        return num_nodes
+
+    def iter_batches(self, files: dict[str, str]) -> Iterator[NodeBatch]:
+        # Nodes of several small files are packed into one batch, and the nodes
+        # of a large file are spread over several batches.
+        nodes: list[BaseNode] = []
+        # [(file, file hash, node ids, position of the file's last node)]
+        pending_files: list[tuple[str, str, list[str], int]] = []
+        emitted = 0
+
+        def take(size: int) -> NodeBatch:
+            nonlocal nodes, emitted
+            batch = NodeBatch(nodes=nodes[:size])
+            nodes = nodes[size:]
+            emitted += size
+            while len(pending_files) > 0 and pending_files[0][3] <= emitted:
+                file, file_hash, node_ids, _ = pending_files.pop(0)
+                batch.completed_files[file] = (file_hash, node_ids)
+            return batch
+
+        for file, documents in self.ingestion.iter_documents(files):
+            file_nodes = self.ingestion.sentence_window_split(documents=documents)
+            nodes.extend(file_nodes)
+            pending_files.append(
+                (
+                    file,
+                    files[file],
+                    [node.node_id for node in file_nodes],
+                    emitted + len(nodes),
+                )
+            )
+            while len(nodes) >= self.batch_size:
+                yield take(self.batch_size)
+
+        if len(nodes) > 0 or len(pending_files) > 0:
+            yield take(len(nodes))
+
+    def embed_batch(self, batch: NodeBatch) -> NodeBatch:
+        self.ingestion.embedding_engine.embed_nodes(batch.nodes)
+        pretokenize_nodes(batch.nodes)
+        return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stream PDFs from the data folder into the Chroma database."
+    )
+    parser.add_argument("--db-name", default="default_db")
+    parser.add_argument("--data-path", default=Ingestion.DATA_PATH)
+    parser.add_argument("--k", type=int, default=None, help="max files to ingest")
+    parser.add_argument("--batch-size", type=int, default=INGESTION_BATCH_SIZE)
+    parser.add_argument("--queue-size", type=int, default=INGESTION_QUEUE_SIZE)
+    parser.add_argument(
+        "--rebuild", action="store_true", help="clear the database first"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    ingestion_index.DATA_PATH = args.data_path
+    if args.rebuild:
+        ingestion_index.clear_database()
+    ingestion_index.sync_chroma(
+        db_name=args.db_name,
+        k=math.inf if args.k is None else args.k,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
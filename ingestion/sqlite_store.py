@@ -0,0 +1,50 @@
+import hashlib
+import sqlite3
+import threading
+
+# Stay below SQLite's limit on the number of bound parameters.
+MAX_BOUND_PARAMETERS = 500
+
+
+class SQLiteStore:
+    """One SQLite file of rows keyed by a sha256 of their text.
+
+    Subclasses list their CREATE statements in SCHEMA. The connection is opened
+    on first use so importing a module that creates a store stays cheap, and is
+    shared between threads behind `_lock`.
+    """
+
+    SCHEMA: list[str] = []
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+        return self._connection
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def select_in(self, query: str, params: list, keys: list[str]) -> list[tuple]:
+        """Rows of `query`, whose "{}" is filled with the placeholders of `keys`.
+
+        Caller must hold self._lock.
+        """
+        rows = []
+        for start in range(0, len(keys), MAX_BOUND_PARAMETERS):
+            chunk = keys[start : start + MAX_BOUND_PARAMETERS]
+            rows.extend(
+                self.connection.execute(
+                    query.format(",".join("?" * len(chunk))), [*params, *chunk]
+                ).fetchall()
+            )
+        return rows
@@ -1,8 +1,6 @@
 from enum import Enum
-from retrievals.chroma_retrieval import DeepRetrievalApi
-from retrievals.graph.graph_retrieval import GraphRetrievalApi
+from retrievals.pool import retriever_pool
 from retrievals.retrieval import Retrieval
-from retrievals.faiss_retrieval import FaissRetrievalApi
 
 
 class RetrievalApiEnum(str, Enum):
@@ -11,12 +9,28 @@ class RetrievalApiEnum(str, Enum):
     NEO4J_RETRIEVAL = "NEO4J_RETRIEVAL"
 
     @staticmethod
-    def get_retrieval(retrieval_type: str, **kwargs) -> Retrieval:
+    def get_retrieval_class(retrieval_type: str):
+        # Imported here so a worker only loads the stack of the backend it serves.
         if retrieval_type == RetrievalApiEnum.NEO4J_RETRIEVAL:
-            return GraphRetrievalApi(**kwargs)
+            from retrievals.graph.graph_retrieval import GraphRetrievalApi
+
+            return GraphRetrievalApi
         elif retrieval_type == RetrievalApiEnum.CHROMA_RETRIEVAL:
-            return DeepRetrievalApi(**kwargs)
+            from retrievals.chroma_retrieval import DeepRetrievalApi
+
+            return DeepRetrievalApi
         elif retrieval_type == RetrievalApiEnum.FAISS_RETRIEVAL:
-            return FaissRetrievalApi(**kwargs)
+            from retrievals.faiss_retrieval import FaissRetrievalApi
+
+            return FaissRetrievalApi
         else:
             raise ValueError("Invalid retrieval API")
+
+    @staticmethod
+    def get_retrieval(retrieval_type: str, **kwargs) -> Retrieval:
+        retrieval_cls = RetrievalApiEnum.get_retrieval_class(retrieval_type)
+
+        # Served from a process-wide pool so backends are not reopened per message.
+        return retriever_pool.get(
+            RetrievalApiEnum(retrieval_type), retrieval_cls, **kwargs
+        )
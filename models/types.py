@@ -10,6 +10,10 @@ class Source(BaseModel):
     page: int
     content: str
     score: float
+    # Source document and sentence range of a sentence window, when known.
+    document_id: str = ""
+    window_start: Optional[int] = None
+    window_end: Optional[int] = None
 
 
 class RoleEnum(str, Enum):
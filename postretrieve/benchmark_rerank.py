@@ -0,0 +1,113 @@
+"""Compare reranker backends on speed and ranking agreement.
+
+    python -m postretrieve.benchmark_rerank --input pairs.jsonl
+    python -m postretrieve.benchmark_rerank --retrieval FAISS_RETRIEVAL \\
+        --query "What are the symptoms of diabetes?" --query "How is asthma treated?"
+
+`--input` is a JSON lines file of {"query": str, "chunks": [str, ...]}. Without
+it, candidates are retrieved for each `--query` from the given retrieval backend.
+Every backend is compared against the first one (torch fp32 by default).
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from postretrieve.rerank import RerankBackend, Reranker, reranking_model
+
+
+def load_candidates(args) -> list[tuple[str, list[str]]]:
+    if args.input is not None:
+        with open(args.input) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return [(row["query"], row["chunks"]) for row in rows]
+
+    from models.enum import RetrievalApiEnum
+
+    retrieval_cls = RetrievalApiEnum.get_retrieval_class(args.retrieval)
+    retriever = retrieval_cls(similarity_top_k=args.top_n).retriever
+    return [
+        (query, [node.get_content() for node in retriever.retrieve(query)])
+        for query in args.query
+    ]
+
+
+def ndcg_at_k(ranking: list[int], gains: np.ndarray, k: int) -> float:
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal = np.sort(gains)[::-1][:k]
+    dcg = float(np.sum(gains[ranking[:k]] * discounts[: len(ranking[:k])]))
+    idcg = float(np.sum(ideal * discounts[: len(ideal)]))
+    return dcg / idcg if idcg > 0 else 1.0
+
+
+def benchmark(
+    reranker: Reranker, candidates: list[tuple[str, list[str]]], repeat: int
+) -> tuple[list[np.ndarray], float]:
+    queries = [query for query, chunks in candidates for _ in chunks]
+    articles = [chunk for _, chunks in candidates for chunk in chunks]
+
+    reranker.score(queries[:8], articles[:8])  # warm up kernels and allocator
+    start = time.perf_counter()
+    for _ in range(repeat):
+        scores = reranker.score(queries, articles)
+    pairs_per_second = len(articles) * repeat / (time.perf_counter() - start)
+
+    # Split the flat scores back per query
+    scores_per_query = []
+    offset = 0
+    for _, chunks in candidates:
+        scores_per_query.append(np.array(scores[offset : offset + len(chunks)]))
+        offset += len(chunks)
+    return scores_per_query, pairs_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=reranking_model)
+    parser.add_argument(
+        "--backends",
+        default=",".join(backend.value for backend in RerankBackend),
+        help="comma separated, the first one is the reference",
+    )
+    parser.add_argument("--input", help="JSON lines of {query, chunks}")
+    parser.add_argument("--retrieval", default="CHROMA_RETRIEVAL")
+    parser.add_argument("--query", action="append", default=[])
+    parser.add_argument("--top-n", type=int, default=20, help="candidates per query")
+    parser.add_argument("--k", type=int, default=5, help="cut-off for agreement")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    candidates = [c for c in load_candidates(args) if len(c[1]) > 0]
+    num_pairs = sum(len(chunks) for _, chunks in candidates)
+    print(f"{len(candidates)} queries, {num_pairs} pairs, model {args.model}")
+
+    reference = None
+    print(f"{'backend':<12}{'pairs/s':>10}{'speedup':>9}{'top-k':>8}{'nDCG':>8}")
+    for backend in args.backends.split(","):
+        # No score cache, repeats would only measure cache hits.
+        reranker = Reranker(args.model, backend=backend, cache=None)
+        scores, pairs_per_second = benchmark(reranker, candidates, args.repeat)
+        if reference is None:
+            reference = (scores, pairs_per_second)
+
+        # Agreement with the reference: share of its top k we also rank in our
+        # top k, and nDCG@k of our order using the reference scores as gains.
+        overlaps, ndcgs = [], []
+        for ours, theirs in zip(scores, reference[0]):
+            k = min(args.k, len(ours))
+            ours_order = list(np.argsort(-ours, kind="stable"))
+            theirs_order = list(np.argsort(-theirs, kind="stable"))
+            overlaps.append(len(set(ours_order[:k]) & set(theirs_order[:k])) / k)
+            ndcgs.append(ndcg_at_k(ours_order, theirs, k))
+
+        print(
+            f"{backend:<12}{pairs_per_second:>10.1f}"
+            f"{pairs_per_second / reference[1]:>8.2f}x"
+            f"{np.mean(overlaps):>8.3f}{np.mean(ndcgs):>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore
+
+from models.types import Source
+
+logger = logging.getLogger(__name__)
+
+
+class PrefilterMethod(str, Enum):
+    BM25 = "bm25"  # Okapi BM25 over the candidate set
+    LEXICAL = "lexical"  # share of query terms found in the chunk
+    RETRIEVAL = "retrieval"  # the score the chunk already has, e.g. embedding cosine
+
+
+# Candidates per query kept for the cross-encoder, 0 disables the cascade.
+RERANK_CASCADE_SIZE = int(os.getenv("RERANK_CASCADE_SIZE", 0))
+RERANK_PREFILTER = os.getenv("RERANK_PREFILTER", PrefilterMethod.BM25.value)
+# Share of requests where every candidate is also cross-encoded to measure how
+# much of the full top k the prefilter kept. Audits run in the background.
+RERANK_CASCADE_AUDIT_RATE = float(os.getenv("RERANK_CASCADE_AUDIT_RATE", 0.05))
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def bm25_scores(
+    query: str, documents: list[str], k1: float = 1.5, b: float = 0.75
+) -> np.ndarray:
+    # IDF comes from the candidates themselves, which is all we have at query time.
+    query_terms = set(tokenize(query))
+    documents_terms = [Counter(tokenize(document)) for document in documents]
+    lengths = np.array([sum(terms.values()) for terms in documents_terms], dtype=float)
+    average_length = max(lengths.mean(), 1.0)
+
+    scores = np.zeros(len(documents))
+    for term in query_terms:
+        frequencies = np.array([terms[term] for terms in documents_terms], dtype=float)
+        document_frequency = np.count_nonzero(frequencies)
+        if document_frequency == 0:
+            continue
+        idf = math.log(
+            1 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5)
+        )
+        scores += (
+            idf
+            * frequencies
+            * (k1 + 1)
+            / (frequencies + k1 * (1 - b + b * lengths / average_length))
+        )
+    return scores
+
+
+def lexical_scores(query: str, documents: list[str]) -> np.ndarray:
+    query_terms = set(tokenize(query))
+    if len(query_terms) == 0:
+        return np.zeros(len(documents))
+    return np.array(
+        [
+            len(query_terms & set(tokenize(document))) / len(query_terms)
+            for document in documents
+        ]
+    )
+
+
+def prefilter_scores(
+    method: PrefilterMethod, query: str, chunks: list[Source | NodeWithScore]
+) -> np.ndarray:
+    if method == PrefilterMethod.RETRIEVAL:
+        return np.array([chunk.score or 0.0 for chunk in chunks], dtype=float)
+
+    documents = [
+        chunk.content if isinstance(chunk, Source) else chunk.get_content()
+        for chunk in chunks
+    ]
+    if method == PrefilterMethod.BM25:
+        return bm25_scores(query, documents)
+    return lexical_scores(query, documents)
+
+
+class RerankCascade:
+    """Cheap prefilter keeps the top `size` candidates, the cross-encoder ranks those.
+
+    Per-stage latency is tracked for every call. Recall of the prefilter (share of
+    the full cross-encoder top k that survived it) is measured on a sample of
+    `audit_rate` of the calls, since it needs the full scoring the cascade avoids.
+    Audits run one at a time on a background thread, off the request path.
+    """
+
+    def __init__(
+        self,
+        reranker,
+        size: int = RERANK_CASCADE_SIZE,
+        method: str = RERANK_PREFILTER,
+        audit_rate: float = RERANK_CASCADE_AUDIT_RATE,
+    ):
+        self.reranker = reranker
+        self.size = size
+        self.method = PrefilterMethod(method)
+        self.audit_rate = audit_rate
+
+        self.calls = 0
+        self.prefilter_seconds = 0.0
+        self.rerank_seconds = 0.0
+        self.recalls: list[float] = []
+        self._lock = threading.Lock()
+        self._audit_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="rerank-audit"
+        )
+
+    def get_top_k_many(
+        self,
+        queries: list[str],
+        candidates_per_query: list[list[Source | NodeWithScore]],
+        k: int = 5,
+    ) -> list[list[Source | NodeWithScore]]:
+        start = time.perf_counter()
+        kept_per_query = []
+        for query, chunks in zip(queries, candidates_per_query):
+            if len(chunks) <= self.size:
+                kept_per_query.append(list(chunks))
+                continue
+            scores = prefilter_scores(self.method, query, chunks)
+            keep = np.argsort(-scores, kind="stable")[: self.size]
+            kept_per_query.append([chunks[i] for i in sorted(keep)])
+        prefiltered = time.perf_counter()
+
+        top_k_per_query = [
+            chunks[:k] for chunks in self.reranker.rerank_many(queries, kept_per_query)
+        ]
+        reranked = time.perf_counter()
+
+        if self.audit_rate > 0 and random.random() < self.audit_rate:
+            self._audit_executor.submit(
+                self._record_audit,
+                queries,
+                [list(chunks) for chunks in candidates_per_query],
+                top_k_per_query,
+                k,
+            )
+
+        with self._lock:
+            self.calls += 1
+            self.prefilter_seconds += prefiltered - start
+            self.rerank_seconds += reranked - prefiltered
+
+        num_candidates = sum(len(chunks) for chunks in candidates_per_query)
+        num_kept = sum(len(chunks) for chunks in kept_per_query)
+        logger.info(
+            f"Rerank cascade: {self.method.value} kept {num_kept}/{num_candidates} "
+            f"in {(prefiltered - start) * 1000:.1f}ms, cross-encoder "
+            f"{(reranked - prefiltered) * 1000:.1f}ms"
+        )
+        return top_k_per_query
+
+    def _record_audit(
+        self,
+        queries: list[str],
+        candidates_per_query: list[list[Source | NodeWithScore]],
+        top_k_per_query: list[list[Source | NodeWithScore]],
+        k: int,
+    ):
+        try:
+            recall = self.audit(queries, candidates_per_query, top_k_per_query, k)
+        except Exception:
+            logger.exception("Rerank cascade audit failed")
+            return
+        with self._lock:
+            self.recalls.append(recall)
+        logger.info(f"Rerank cascade audit: recall@{k} {recall:.2f}")
+
+    def audit(
+        self,
+        queries: list[str],
+        candidates_per_query: list[list[Source | NodeWithScore]],
+        top_k_per_query: list[list[Source | NodeWithScore]],
+        k: int,
+    ) -> float:
+        # Reranking sets the score of each chunk, copies keep the returned
+        # chunks untouched while the request is still using them.
+        copies_per_query = [
+            [chunk.model_copy() for chunk in chunks] for chunks in candidates_per_query
+        ]
+        originals = {
+            id(copy): id(chunk)
+            for copies, chunks in zip(copies_per_query, candidates_per_query)
+            for copy, chunk in zip(copies, chunks)
+        }
+        full_per_query = self.reranker.rerank_many(queries, copies_per_query)
+        recalls = []
+        for full, top_k in zip(full_per_query, top_k_per_query):
+            expected = {originals[id(chunk)] for chunk in full[:k]}
+            if len(expected) > 0:
+                recalls.append(
+                    len(expected & {id(chunk) for chunk in top_k}) / len(expected)
+                )
+        return float(np.mean(recalls)) if len(recalls) > 0 else 1.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = max(self.calls, 1)
+            return {
+                "calls": self.calls,
+                "prefilter_ms": 1000 * self.prefilter_seconds / calls,
+                "rerank_ms": 1000 * self.rerank_seconds / calls,
+                "audited": len(self.recalls),
+                "recall": float(np.mean(self.recalls)) if self.recalls else None,
+            }
@@ -0,0 +1,189 @@
+import logging
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import MetadataMode
+
+from generations.context_packer import get_token_counter
+from ingestion.embedding import CachedEmbedding, get_query_embedding_batch
+from models.types import Source
+from postretrieve.window_merge import split_sentences
+
+logger = logging.getLogger(__name__)
+
+# Share of the context tokens kept by the compression.
+CONTEXT_COMPRESSION_RATIO = float(os.getenv("CONTEXT_COMPRESSION_RATIO", 0.5))
+# Marks the place of dropped sentences inside a passage.
+ELLIPSIS = " ... "
+
+
+@dataclass
+class CompressionResult:
+    sources: list[Source] = field(default_factory=list)
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.tokens_after / self.tokens_before if self.tokens_before else 1.0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def get_sentence_embeddings(
+    embed_model: BaseEmbedding,
+    sources: list[Source],
+    flat: list[tuple[int, int]],
+    texts: list[str],
+    retrieval=None,
+) -> list[list[float]]:
+    """Embeddings of `texts` in the format ingestion embedded them, metadata included.
+
+    Embeddings of the sentence nodes in the vector store are reused. Other
+    sentences are embedded as a stored node of their document with the sentence
+    swapped in. When a source has no stored node to copy that format from,
+    every sentence is embedded bare instead, so the two never share a ranking.
+    """
+    nodes = []
+    if hasattr(retrieval, "get_sentence_nodes"):
+        nodes = retrieval.get_sentence_nodes(
+            [source.document_id for source in sources if source.document_id]
+        )
+    stored = {}
+    templates = {}
+    for node in nodes:
+        templates.setdefault(node.ref_doc_id, node)
+        stored[(node.ref_doc_id, " ".join(node.get_content().split()))] = node.embedding
+
+    document_ids = [sources[source_idx].document_id for source_idx, _ in flat]
+    if all(document_id in templates for document_id in document_ids):
+        embeddings = [
+            stored.get((document_id, " ".join(text.split())))
+            for document_id, text in zip(document_ids, texts)
+        ]
+    else:
+        embeddings = [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if len(missing) > 0:
+        missing_texts = []
+        for i in missing:
+            if document_ids[i] in templates:
+                node = templates[document_ids[i]].model_copy()
+                node.set_content(texts[i])
+                missing_texts.append(node.get_content(metadata_mode=MetadataMode.EMBED))
+            else:
+                missing_texts.append(texts[i])
+        # The base model, the persistent cache is for corpus chunks.
+        if isinstance(embed_model, CachedEmbedding):
+            embed_model = embed_model.embed_model
+        for i, embedding in zip(
+            missing, embed_model.get_text_embedding_batch(missing_texts)
+        ):
+            embeddings[i] = embedding
+    logger.info(
+        f"{len(texts) - len(missing)}/{len(texts)} sentence embeddings "
+        "read from the vector store"
+    )
+    return embeddings
+
+
+def compress_sources(
+    query: str,
+    sources: list[Source],
+    model_name: str,
+    embed_model: BaseEmbedding | None = None,
+    ratio: float = CONTEXT_COMPRESSION_RATIO,
+    retrieval=None,
+) -> CompressionResult:
+    """Keep the sentences of `sources` closest to `query`, about `ratio` of the tokens.
+
+    Sentences are ranked by cosine similarity to the query over all sources
+    and taken until the target is reached. Every source keeps at least its best
+    sentence so each reference still backs part of the context, and kept
+    sentences stay in their original order.
+
+    Sentence embeddings are read from the vector store when `retrieval` offers
+    `get_sentence_nodes` (Chroma), every sentence of an ingested window is
+    stored there as its own node. Sentences it does not have are embedded on
+    each call, which for an API embedding model is one paid request per turn;
+    they skip the persistent embedding cache, which holds corpus chunks only.
+    The query costs one more embedding unless it is already cached.
+    """
+    if embed_model is None:
+        embed_model = getattr(retrieval, "embed_model", None)
+    if embed_model is None:
+        from ingestion.ingestion import ingestion_index
+
+        embed_model = ingestion_index.embed_model
+
+    counter = get_token_counter(model_name)
+    sentences_per_source = [split_sentences(source.content) for source in sources]
+    flat = [
+        (source_idx, sentence_idx)
+        for source_idx, sentences in enumerate(sentences_per_source)
+        for sentence_idx in range(len(sentences))
+    ]
+    tokens_before = sum(counter.count(source.content) for source in sources)
+    if len(flat) == 0:
+        return CompressionResult(list(sources), tokens_before, tokens_before)
+
+    texts = [sentences_per_source[s][i] for s, i in flat]
+    query_embedding = np.asarray(
+        get_query_embedding_batch(embed_model, [query])[0], dtype=float
+    )
+    sentence_embeddings = np.asarray(
+        get_sentence_embeddings(embed_model, sources, flat, texts, retrieval),
+        dtype=float,
+    )
+    # Cosine similarity, not every provider returns normalized vectors.
+    query_embedding /= np.linalg.norm(query_embedding) + 1e-12
+    sentence_embeddings /= (
+        np.linalg.norm(sentence_embeddings, axis=1, keepdims=True) + 1e-12
+    )
+    similarities = sentence_embeddings @ query_embedding
+    sentence_tokens = [counter.count(text) for text in texts]
+
+    order = [int(position) for position in np.argsort(-similarities, kind="stable")]
+    best_per_source: dict[int, int] = {}
+    for position in order:
+        best_per_source.setdefault(flat[position][0], position)
+    kept = set(best_per_source.values())
+
+    target = ratio * sum(sentence_tokens)
+    kept_tokens = sum(sentence_tokens[i] for i in kept)
+    for position in order:
+        if kept_tokens >= target:
+            break
+        if position not in kept:
+            kept.add(position)
+            kept_tokens += sentence_tokens[position]
+
+    compressed = []
+    for source_idx, source in enumerate(sources):
+        positions = [p for p in sorted(kept) if flat[p][0] == source_idx]
+        parts = []
+        previous = -1
+        for p in positions:
+            sentence_idx = flat[p][1]
+            if sentence_idx > previous + 1 and previous >= 0:
+                parts.append(ELLIPSIS)
+            elif len(parts) > 0:
+                parts.append(" ")
+            parts.append(texts[p])
+            previous = sentence_idx
+        compressed.append(source.model_copy(update={"content": "".join(parts)}))
+
+    result = CompressionResult(
+        sources=compressed,
+        tokens_before=tokens_before,
+        tokens_after=sum(counter.count(source.content) for source in compressed),
+    )
+    logger.info(
+        f"Compressed context to {result.ratio:.0%} of {result.tokens_before} tokens, "
+        f"{result.tokens_saved} saved ({len(kept)}/{len(flat)} sentences)"
+    )
+    return result
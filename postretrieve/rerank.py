@@ -1,59 +1,349 @@
 import logging
 import os
+import threading
+from enum import Enum
 
-import torch
 from llama_index.core.schema import NodeWithScore
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
 from models.types import Source
+from postretrieve.cascade import RERANK_CASCADE_SIZE, RerankCascade
+from postretrieve.score_cache import ScoreCache, score_cache
+from postretrieve.token_store import ChunkTokenStore, chunk_token_store
 
 logger = logging.getLogger(__name__)
 reranking_model = os.getenv("RERANKING_MODEL", "ncbi/MedCPT-Cross-Encoder")
 
 
+class RerankBackend(str, Enum):
+    TORCH = "torch"  # fp32 PyTorch
+    TORCH_INT8 = "torch-int8"  # PyTorch with dynamic int8 quantization of Linear layers
+    ONNX = "onnx"  # ONNX Runtime with all graph optimizations, needs optimum
+
+
+RERANKING_BACKEND = os.getenv("RERANKING_BACKEND", RerankBackend.TORCH.value)
+# Exported ONNX models are kept here so only the first start pays for the export.
+RERANKING_ONNX_PATH = os.getenv("RERANKING_ONNX_PATH", "onnx")
+
+
+def truncate_pair(
+    first: list[int], second: list[int], max_length: int
+) -> tuple[list[int], list[int]]:
+    """Same cut as the tokenizer's `truncation="longest_first"` on a pair."""
+    if len(first) + len(second) <= max_length:
+        return first, second
+
+    half = max_length // 2
+    if len(first) <= half:
+        return first, second[: max_length - len(first)]
+    if len(second) <= half:
+        return first[: max_length - len(second)], second
+    # Both are long: split evenly, the longer one (or the second) gets the odd token.
+    if len(first) > len(second):
+        return first[: max_length - half], second[:half]
+    return first[:half], second[: max_length - half]
+
+
 class Reranker:
-    def __init__(self, model_name: str = "ncbi/MedCPT-Cross-Encoder"):
+    def __init__(
+        self,
+        model_name: str = "ncbi/MedCPT-Cross-Encoder",
+        backend: str = RERANKING_BACKEND,
+        cache: ScoreCache | None = score_cache,
+        cascade_size: int = RERANK_CASCADE_SIZE,
+        token_store: ChunkTokenStore | None = chunk_token_store,
+    ):
+        # torch and transformers take seconds to import, so only on first use.
+        from transformers import AutoTokenizer
+
         self.model_name = model_name
-        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.backend = RerankBackend(backend)
+        self.cache = cache
+        # Quantized or exported models score slightly differently, keep them apart.
+        self.cache_model_key = f"{model_name}#{self.backend.value}"
+        self.model = self.__load_model()
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Pre-tokenized pairs are assembled in the BERT layout, so only for
+        # tokenizers that have one.
+        self.token_store = (
+            token_store
+            if self.tokenizer.cls_token_id is not None
+            and self.tokenizer.sep_token_id is not None
+            else None
+        )
+        # Optional cheap first stage in front of the cross-encoder for get_top_k*.
+        self.cascade = (
+            RerankCascade(self, size=cascade_size) if cascade_size > 0 else None
+        )
+
+        # Fast tokenizers are not safe to call from several threads at once.
+        self._lock = threading.Lock()
+
+    def __load_model(self):
+        if self.backend == RerankBackend.ONNX:
+            return self.__load_onnx_model()
+
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        model.eval()
+        if self.backend == RerankBackend.TORCH_INT8:
+            # Weights of every Linear layer stored as int8, activations quantized
+            # on the fly. Most of the cross-encoder's compute is in those layers.
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def __load_onnx_model(self):
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+        except ImportError as e:
+            raise ImportError(
+                "RERANKING_BACKEND=onnx needs ONNX Runtime and optimum: "
+                "pip install 'optimum[onnxruntime]'"
+            ) from e
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+
+        onnx_path = os.path.join(RERANKING_ONNX_PATH, self.model_name)
+        if os.path.exists(onnx_path):
+            return ORTModelForSequenceClassification.from_pretrained(
+                onnx_path, session_options=session_options
+            )
+
+        logger.info(f"Exporting {self.model_name} to ONNX in {onnx_path}")
+        model = ORTModelForSequenceClassification.from_pretrained(
+            self.model_name, export=True, session_options=session_options
+        )
+        model.save_pretrained(onnx_path)
+        return model
 
     def rerank(
         self, query: str, chunks: list[Source | NodeWithScore]
     ) -> list[Source | NodeWithScore]:
-        # combine query article into pairs
+        return self.rerank_many([query], [chunks])[0]
+
+    def rerank_many(
+        self,
+        queries: list[str],
+        candidates_per_query: list[list[Source | NodeWithScore]],
+        batch_size: int = 32,
+    ) -> list[list[Source | NodeWithScore]]:
+        # Flatten every (query, chunk) pair so all queries share one pass.
+        pairs = [
+            (query_idx, chunk)
+            for query_idx, chunks in enumerate(candidates_per_query)
+            for chunk in chunks
+        ]
+        if len(pairs) == 0:
+            return [[] for _ in candidates_per_query]
+
         articles = [
             chunk.content if isinstance(chunk, Source) else chunk.get_content()
-            for chunk in chunks
+            for _, chunk in pairs
+        ]
+        scores = self.score(
+            [queries[query_idx] for query_idx, _ in pairs],
+            articles,
+            batch_size=batch_size,
+        )
+        logger.debug(f"Reranked {len(pairs)} pairs for {len(queries)} queries")
+
+        # Set the new scores for each chunk and scatter them back to their query
+        for (_, chunk), score in zip(pairs, scores):
+            chunk.score = score
+
+        return [
+            sorted(chunks, key=lambda x: x.score, reverse=True)
+            for chunks in candidates_per_query
         ]
-        pairs = [[query, article] for article in articles]
-
-        # infer scores
-        with torch.no_grad():
-            encoded = self.tokenizer(
-                pairs,
-                truncation=True,
-                padding=True,
-                return_tensors="pt",
-                max_length=512,
+
+    def score(
+        self, queries: list[str], articles: list[str], batch_size: int = 32
+    ) -> list[float]:
+        """Relevance in [0, 1] of each (queries[i], articles[i]) pair.
+
+        Pairs found in the score cache are not sent to the model again.
+        """
+        if self.cache is None:
+            return self._score(queries, articles, batch_size)
+
+        keys = [
+            self.cache.make_key(self.cache_model_key, query, article)
+            for query, article in zip(queries, articles)
+        ]
+        scores = self.cache.get_many(keys)
+
+        # Score every missing pair once, even if it appears several times.
+        missing: dict[tuple, int] = {}
+        for i, (key, score) in enumerate(zip(keys, scores)):
+            if score is None:
+                missing.setdefault(key, i)
+        if len(missing) > 0:
+            new_scores = self._score(
+                [queries[i] for i in missing.values()],
+                [articles[i] for i in missing.values()],
+                batch_size,
             )
+            self.cache.put_many(list(missing), new_scores)
+            key_scores = dict(zip(missing, new_scores))
+            scores = [
+                key_scores[key] if score is None else score
+                for key, score in zip(keys, scores)
+            ]
+
+        logger.debug(
+            f"Rerank cache: {len(queries) - len(missing)}/{len(queries)} pairs "
+            f"cached, {self.cache.stats()}"
+        )
+        return scores
+
+    def _score(
+        self, queries: list[str], articles: list[str], batch_size: int
+    ) -> list[float]:
+        import torch
+
+        scores = [0.0] * len(queries)
+        if len(queries) == 0:
+            return scores
 
-            # tensor([  6.9363,  -8.2063,  -8.7692, -12.3450, -10.4416, -15.8475])
-            logits = self.model(**encoded).logits.squeeze(dim=1)
+        # Only the tokenizer is locked; forward passes of concurrent requests,
+        # e.g. a background cascade audit, run side by side.
+        with self._lock:
+            if self.token_store is None:
+                encoded = self.tokenizer(
+                    queries,
+                    articles,
+                    truncation=True,
+                    max_length=512,
+                )
+            else:
+                encoded = self.__encode_pretokenized(queries, articles)
 
-            # Convert to 0-1 range through sigmoid
-            scores = torch.sigmoid(logits).tolist()
-            logger.info(f"{logits=}\n{scores=}")
+        # Sort by token length so each micro-batch pads to a similar length.
+        order = sorted(range(len(queries)), key=lambda i: len(encoded["input_ids"][i]))
+        for start in range(0, len(order), batch_size):
+            batch_idx = order[start : start + batch_size]
+            with self._lock:
+                batch = self.tokenizer.pad(
+                    {
+                        key: [value[i] for i in batch_idx]
+                        for key, value in encoded.items()
+                    },
+                    return_tensors="pt",
+                )
 
-        # Set the new scores for each chunk
-        for i, chunk in enumerate(chunks):
-            chunk.score = scores[i]
+            with torch.no_grad():
+                # tensor([  6.9363,  -8.2063,  -8.7692, -12.3450, -10.4416, -15.8475])
+                logits = self.model(**batch).logits.squeeze(dim=1)
 
-        return sorted(chunks, key=lambda x: x.score, reverse=True)
+                # Convert to 0-1 range through sigmoid
+                for i, score in zip(batch_idx, torch.sigmoid(logits).tolist()):
+                    scores[i] = score
+        return scores
+
+    def __encode_pretokenized(self, queries: list[str], articles: list[str]) -> dict:
+        # Same input as tokenizing each (query, article) pair, but chunk token ids
+        # come from the store filled at ingestion; only queries are tokenized.
+        unique_queries = list(dict.fromkeys(queries))
+        query_ids = dict(
+            zip(
+                unique_queries,
+                self.tokenizer(unique_queries, add_special_tokens=False)["input_ids"],
+            )
+        )
+        article_ids = self.token_store.tokenize(self.tokenizer, articles)
+
+        encoded: dict[str, list] = {
+            "input_ids": [],
+            "token_type_ids": [],
+            "attention_mask": [],
+        }
+        cls, sep = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id
+        for query, ids in zip(queries, article_ids):
+            first, second = truncate_pair(query_ids[query], ids, max_length=512 - 3)
+            # BERT pair layout, as MedCPT expects: [CLS] query [SEP] chunk [SEP]
+            input_ids = [cls, *first, sep, *second, sep]
+            encoded["input_ids"].append(input_ids)
+            encoded["token_type_ids"].append(
+                [0] * (len(first) + 2) + [1] * (len(second) + 1)
+            )
+            encoded["attention_mask"].append([1] * len(input_ids))
+        return encoded
 
     def get_top_k(
         self, query: str, chunks: list[Source | NodeWithScore], k: int = 5
     ) -> list[Source | NodeWithScore]:
         # Avoid modifying the original list
-        print(f"Hello {chunks}")
         chunks = chunks.copy()
-        return self.rerank(query, chunks)[: min(k, len(chunks))]
+        return self.get_top_k_many([query], [chunks], k=k)[0]
+
+    def get_top_k_many(
+        self,
+        queries: list[str],
+        candidates_per_query: list[list[Source | NodeWithScore]],
+        k: int = 5,
+    ) -> list[list[Source | NodeWithScore]]:
+        if self.cascade is not None:
+            return self.cascade.get_top_k_many(queries, candidates_per_query, k=k)
+        return [
+            chunks[:k] for chunks in self.rerank_many(queries, candidates_per_query)
+        ]
+
+
+# Process-wide registry so every caller shares one loaded cross-encoder per model.
+_rerankers: dict[tuple[str, RerankBackend], Reranker] = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(
+    model_name: str = reranking_model, backend: str = RERANKING_BACKEND
+) -> Reranker:
+    """Return the shared Reranker for (`model_name`, `backend`), loading it on first use."""
+    key = (model_name, RerankBackend(backend))
+    reranker = _rerankers.get(key)
+    if reranker is not None:
+        return reranker
+
+    with _rerankers_lock:
+        # Another thread may have loaded it while we were waiting for the lock.
+        if key not in _rerankers:
+            logger.info(f"Loading reranking model {model_name} ({key[1].value})")
+            _rerankers[key] = Reranker(model_name, backend=backend)
+        return _rerankers[key]
+
+
+_tokenizers: dict[str, object] = {}
+
+
+def get_reranker_tokenizer(model_name: str = reranking_model):
+    """Tokenizer of the reranking model alone, e.g. to pre-tokenize at ingestion."""
+    reranker = next(
+        (r for (name, _), r in list(_rerankers.items()) if name == model_name), None
+    )
+    if reranker is not None:
+        return reranker.tokenizer
+
+    with _rerankers_lock:
+        if model_name not in _tokenizers:
+            from transformers import AutoTokenizer
+
+            _tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name)
+        return _tokenizers[model_name]
+
+
+def warm_up(
+    model_name: str = reranking_model, backend: str = RERANKING_BACKEND
+) -> Reranker:
+    """Load the reranker and run a dummy pass so the first request is not slow."""
+    reranker = get_reranker(model_name, backend)
+    reranker.rerank(
+        "warm up",
+        [Source(id="", doi="", file_name="", page=1, content="warm up", score=0)],
+    )
+    return reranker
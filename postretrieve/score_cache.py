@@ -0,0 +1,84 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 100_000))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", 24 * 60 * 60))
+
+
+class ScoreCache:
+    """In-memory LRU of reranker scores with a time to live.
+
+    Keys are (model, normalized query hash, chunk content hash), so a pair is
+    only scored once however often the same query and text come back, e.g. a
+    recurring question or a chunk found by several retrievers. A different query
+    or text is a new pair; the cache never changes what gets scored.
+    """
+
+    def __init__(
+        self, max_entries: int = RERANK_CACHE_SIZE, ttl: float = RERANK_CACHE_TTL
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        # Case and spacing do not change what the user asked.
+        return " ".join(query.lower().split())
+
+    def make_key(self, model: str, query: str, article: str) -> tuple:
+        return (
+            model,
+            self.hash_text(self.normalize_query(query)),
+            self.hash_text(article),
+        )
+
+    def get_many(self, keys: list[tuple]) -> list[float | None]:
+        now = time.monotonic()
+        scores = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and now - entry[1] > self.ttl:
+                    del self._entries[key]
+                    entry = None
+
+                if entry is None:
+                    self.misses += 1
+                    scores.append(None)
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    scores.append(entry[0])
+        return scores
+
+    def put_many(self, keys: list[tuple], scores: list[float]):
+        now = time.monotonic()
+        with self._lock:
+            for key, score in zip(keys, scores):
+                self._entries[key] = (score, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+score_cache = ScoreCache()
@@ -0,0 +1,150 @@
+import logging
+import os
+from collections import OrderedDict
+from typing import Sequence
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+from ingestion.sqlite_store import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+RERANK_TOKEN_STORE_PATH = os.getenv("RERANK_TOKEN_STORE_PATH", "rerank_tokens.sqlite3")
+# Texts first seen at query time (merged or compressed passages) are only kept
+# in memory, up to this many.
+RERANK_TOKEN_MEMORY_SIZE = int(os.getenv("RERANK_TOKEN_MEMORY_SIZE", 10_000))
+
+
+class ChunkTokenStore(SQLiteStore):
+    """Reranker token ids of chunk texts, keyed by (tokenizer, sha256 of text).
+
+    Filled at ingestion so the reranker only tokenizes the query per request.
+    Keyed by content rather than node id, so it also covers the sentence window
+    text that replaces a node's content after retrieval. Only ingestion writes to
+    disk; texts missing at query time go to a bounded in-memory LRU, so the file
+    grows with the corpus and not with traffic.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS chunk_tokens (
+            tokenizer TEXT NOT NULL,
+            text_hash TEXT NOT NULL,
+            token_ids BLOB NOT NULL,
+            PRIMARY KEY (tokenizer, text_hash)
+        )"""
+    ]
+
+    def __init__(
+        self,
+        path: str = RERANK_TOKEN_STORE_PATH,
+        memory_size: int = RERANK_TOKEN_MEMORY_SIZE,
+    ):
+        super().__init__(path)
+        self.memory_size = memory_size
+        self._memory: OrderedDict[tuple[str, str], list[int]] = OrderedDict()
+
+    def get_many(self, tokenizer: str, texts: list[str]) -> list[list[int] | None]:
+        hashes = [self.hash_text(text) for text in texts]
+        with self._lock:
+            rows = self.select_in(
+                "SELECT text_hash, token_ids FROM chunk_tokens "
+                "WHERE tokenizer = ? AND text_hash IN ({})",
+                [tokenizer],
+                hashes,
+            )
+        found = {
+            text_hash: np.frombuffer(blob, dtype=np.int32).tolist()
+            for text_hash, blob in rows
+        }
+        return [found.get(text_hash) for text_hash in hashes]
+
+    def put_many(self, tokenizer: str, texts: list[str], token_ids: list[list[int]]):
+        rows = [
+            (tokenizer, self.hash_text(text), np.asarray(ids, dtype=np.int32).tobytes())
+            for text, ids in zip(texts, token_ids)
+        ]
+        with self._lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO chunk_tokens VALUES (?, ?, ?)", rows
+            )
+            self.connection.commit()
+
+    def get_memory(self, tokenizer: str, texts: list[str]) -> list[list[int] | None]:
+        token_ids = []
+        with self._lock:
+            for text in texts:
+                key = (tokenizer, self.hash_text(text))
+                ids = self._memory.get(key)
+                if ids is not None:
+                    self._memory.move_to_end(key)
+                token_ids.append(ids)
+        return token_ids
+
+    def put_memory(self, tokenizer: str, texts: list[str], token_ids: list[list[int]]):
+        with self._lock:
+            for text, ids in zip(texts, token_ids):
+                key = (tokenizer, self.hash_text(text))
+                self._memory[key] = ids
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def tokenize(
+        self, tokenizer, texts: list[str], persist: bool = False
+    ) -> list[list[int]]:
+        """Token ids of `texts` without special tokens, from the store when known.
+
+        New texts are written to disk with `persist` (ingestion) and kept in
+        memory otherwise (query time).
+        """
+        token_ids = self.get_memory(tokenizer.name_or_path, texts)
+        missing = [i for i, ids in enumerate(token_ids) if ids is None]
+        if len(missing) > 0:
+            stored = self.get_many(tokenizer.name_or_path, [texts[i] for i in missing])
+            for i, ids in zip(missing, stored):
+                token_ids[i] = ids
+            missing = [i for i in missing if token_ids[i] is None]
+        if len(missing) > 0:
+            # Unique texts only, sentence windows overlap a lot.
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_ids = tokenizer(
+                missing_texts,
+                add_special_tokens=False,
+                truncation=True,
+                max_length=512,
+            )["input_ids"]
+            if persist:
+                self.put_many(tokenizer.name_or_path, missing_texts, new_ids)
+            else:
+                self.put_memory(tokenizer.name_or_path, missing_texts, new_ids)
+            by_text = dict(zip(missing_texts, new_ids))
+            for i in missing:
+                token_ids[i] = by_text[texts[i]]
+        return token_ids
+
+
+chunk_token_store = ChunkTokenStore()
+
+
+def pretokenize_nodes(nodes: Sequence[BaseNode]):
+    """Store reranker token ids for the texts the reranker will see for `nodes`.
+
+    That is the node's sentence, reranked against each query in the retrievers,
+    and its sentence window, which replaces the sentence afterwards and is what
+    the app's rerank scores. Best effort: when the reranker tokenizer cannot be
+    loaded, ingestion goes on and the reranker tokenizes those texts itself.
+    """
+    from postretrieve.rerank import get_reranker_tokenizer
+
+    texts = []
+    for node in nodes:
+        texts.append(node.get_content())
+        if "window" in node.metadata:
+            texts.append(node.metadata["window"])
+    if len(texts) == 0:
+        return
+    try:
+        chunk_token_store.tokenize(get_reranker_tokenizer(), texts, persist=True)
+    except Exception as e:
+        logger.warning(f"Skipped pre-tokenizing {len(texts)} texts: {e}")
@@ -0,0 +1,134 @@
+import logging
+from functools import lru_cache
+from typing import Sequence
+
+from llama_index.core.schema import BaseNode
+
+from models.types import Source
+
+logger = logging.getLogger(__name__)
+
+# Sentence range of a node's window inside its source document, end exclusive.
+WINDOW_START_KEY = "window_start"
+WINDOW_END_KEY = "window_end"
+
+
+@lru_cache(maxsize=1)
+def get_sentence_splitter():
+    # The splitter SentenceWindowNodeParser builds the windows from.
+    from llama_index.core.node_parser.text.utils import split_by_sentence_tokenizer
+
+    return split_by_sentence_tokenizer()
+
+
+def split_sentences(text: str) -> list[str]:
+    return [s.strip() for s in get_sentence_splitter()(text) if s.strip()]
+
+
+def set_window_positions(nodes: Sequence[BaseNode], window_size: int):
+    """Record where each node's sentence window sits in its source document.
+
+    `nodes` are the output of SentenceWindowNodeParser, one node per sentence in
+    document order. The positions are kept out of the embedded and LLM text.
+    """
+    counts: dict[str, int] = {}
+    for node in nodes:
+        counts[node.ref_doc_id] = counts.get(node.ref_doc_id, 0) + 1
+
+    seen: dict[str, int] = {}
+    for node in nodes:
+        i = seen.get(node.ref_doc_id, 0)
+        seen[node.ref_doc_id] = i + 1
+        node.metadata[WINDOW_START_KEY] = max(0, i - window_size)
+        node.metadata[WINDOW_END_KEY] = min(
+            counts[node.ref_doc_id], i + window_size + 1
+        )
+        node.excluded_embed_metadata_keys.extend([WINDOW_START_KEY, WINDOW_END_KEY])
+        node.excluded_llm_metadata_keys.extend([WINDOW_START_KEY, WINDOW_END_KEY])
+
+
+def window_sentences(source: Source) -> list[str] | None:
+    """Raw sentences of a window, or None if they do not match its position."""
+    if not source.document_id or source.window_start is None:
+        return None
+    sentences = get_sentence_splitter()(source.content)
+    if len(sentences) != source.window_end - source.window_start:
+        return None
+    return sentences
+
+
+def join_sentences(sentences: list[str]) -> str:
+    # Windows are the raw sentences joined by a space, so a single window
+    # comes out exactly as it was stored.
+    text = ""
+    for sentence in sentences:
+        if len(text) > 0 and not text[-1].isspace():
+            text += " "
+        text += sentence
+    return text
+
+
+def merge_windows(sources: list[Source]) -> list[Source]:
+    """Merge overlapping or adjacent sentence windows of a document into one span.
+
+    Neighbouring sentence hits carry windows that share most of their
+    sentences. Hits of the same source document whose sentence ranges overlap or
+    touch are merged into one span that contains every sentence once, in
+    document order. The span keeps the id, page and score of its best hit, so
+    merging never ranks a span above a distinct passage that scored higher.
+
+    Sources without a window position (other retrievers, indexes built before
+    positions were recorded) and windows that merge with nothing are returned
+    unchanged.
+    """
+    groups: dict[str, list[tuple[Source, list[str]]]] = {}
+    merged_sources: list[Source] = []
+    for source in sources:
+        sentences = window_sentences(source)
+        if sentences is None:
+            merged_sources.append(source)
+        else:
+            groups.setdefault(source.document_id, []).append((source, sentences))
+
+    for members in groups.values():
+        members.sort(key=lambda member: member[0].window_start)
+        runs = [[members[0]]]
+        for member in members[1:]:
+            run_end = max(source.window_end for source, _ in runs[-1])
+            if member[0].window_start <= run_end:
+                runs[-1].append(member)
+            else:
+                runs.append([member])
+
+        for run in runs:
+            if len(run) == 1:
+                merged_sources.append(run[0][0])
+                continue
+
+            # Each position takes its sentence from the first window covering it.
+            by_position: dict[int, str] = {}
+            for source, sentences in run:
+                for offset, sentence in enumerate(sentences):
+                    by_position.setdefault(source.window_start + offset, sentence)
+            positions = sorted(by_position)
+
+            best = max((source for source, _ in run), key=lambda s: s.score)
+            merged_sources.append(
+                best.model_copy(
+                    update={
+                        "content": join_sentences([by_position[p] for p in positions]),
+                        "window_start": positions[0],
+                        "window_end": positions[-1] + 1,
+                    }
+                )
+            )
+
+    merged_sources.sort(key=lambda source: source.score, reverse=True)
+    if len(merged_sources) < len(sources):
+        before = sum(len(source.content) for source in sources)
+        after = sum(len(source.content) for source in merged_sources)
+        logger.info(
+            f"Merged {len(sources)} windows into {len(merged_sources)} spans, "
+            f"{before} -> {after} characters"
+        )
+    return merged_sources
@@ -1,12 +1,11 @@
 import logging
+import threading
 
 from langchain.output_parsers import PydanticOutputParser
-from langchain_community.chat_models import ChatOpenAI
-from langchain_community.llms.ollama import Ollama
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from const import API_KEY
+from generations.completion import get_model, get_provider_semaphore
 
 logger = logging.getLogger(__name__)
 
@@ -28,19 +27,17 @@ class ParaphrasedQuery(BaseModel):
 
 # llm = Ollama(model="llama2")
 class QueryExpansion:
-    def __init__(self, with_openAI: bool):
-        self.LLM_factory("", with_openAI)
+    def __init__(self, with_openAI: bool, model: str = ""):
+        self.LLM_factory(model, with_openAI)
 
     def LLM_factory(self, model, with_openAI: bool):
+        # Shared clients from the pool, no output cap as before.
         if with_openAI:
-            self.llm = ChatOpenAI(
-                model="gpt-3.5-turbo-0125", temperature=0.1, api_key=API_KEY
-            )
+            self.model = "gpt-3.5-turbo-0125"
+            self.llm = get_model(self.model, 0.1, max_tokens=None)
         else:
-            if len(model) > 0:
-                self.llm = Ollama(model=model)
-            else:
-                self.llm = Ollama(model="llama2")
+            self.model = model if len(model) > 0 else "llama2"
+            self.llm = get_model(self.model, None, max_tokens=None)
 
         parser = PydanticOutputParser(pydantic_object=ParaphrasedQuery)
         prompt = PromptTemplate(
@@ -52,7 +49,21 @@ class QueryExpansion:
         self.chain = prompt | self.llm | parser
 
     def paraphase_query(self, query: str):
-        response = self.chain.invoke(query)
+        with get_provider_semaphore(self.model):
+            response = self.chain.invoke(query)
         response.paraphrased_query.append(query)
         logger.debug(response)
         return response.paraphrased_query
+
+
+_query_expansions: dict[tuple[str, bool], QueryExpansion] = {}
+_query_expansions_lock = threading.Lock()
+
+
+def get_query_expansion(with_openAI: bool, model: str = "") -> QueryExpansion:
+    """Shared QueryExpansion per model, its chain is built once."""
+    key = (model, with_openAI)
+    with _query_expansions_lock:
+        if key not in _query_expansions:
+            _query_expansions[key] = QueryExpansion(with_openAI, model)
+        return _query_expansions[key]
@@ -1,10 +1,11 @@
 import logging
+import threading
 
 from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from generations.completion import get_model
+from generations.completion import get_model, get_provider_semaphore
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +19,7 @@ class HypotheticalDocument(BaseModel):
 
 class HyDE:
     def __init__(self, model: str = "gpt-3.5-turbo-0125"):
+        self.model = model
         self.initialize_llm(model)
 
     def initialize_llm(self, model: str):
@@ -34,6 +36,19 @@ class HyDE:
         self.chain = prompt | self.llm | parser
 
     def run(self, query: str) -> str:
-        response: HypotheticalDocument = self.chain.invoke(query)
+        with get_provider_semaphore(self.model):
+            response: HypotheticalDocument = self.chain.invoke(query)
         logger.debug(response)
         return response.passage
+
+
+_hydes: dict[str, HyDE] = {}
+_hydes_lock = threading.Lock()
+
+
+def get_hyde(model: str = "gpt-3.5-turbo-0125") -> HyDE:
+    """Shared HyDE per model, its chain is built once."""
+    with _hydes_lock:
+        if model not in _hydes:
+            _hydes[model] = HyDE(model)
+        return _hydes[model]
@@ -1,11 +1,20 @@
 import logging
+import math
 from typing import List
 
-from llama_index.core.schema import NodeWithScore
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import (
+    legacy_metadata_dict_to_node,
+    metadata_dict_to_node,
+)
 
+from ingestion.embedding import get_embed_model, get_query_embedding_batch
 from ingestion.ingestion import ingestion_index
 from models.types import Source
-from postretrieve.rerank import Reranker
+from postretrieve.rerank import get_reranker
+from postretrieve.window_merge import WINDOW_END_KEY, WINDOW_START_KEY
+from retrievals.fusion import fuse_results
 from retrievals.retrieval import Retrieval
 from llama_index.core.vector_stores.types import (
     VectorStoreQueryMode,
@@ -20,43 +29,120 @@ logger = logging.getLogger(__name__)
 class DeepRetrievalApi:
     # Retrieve using deep models.
 
-    def __init__(self, **kwargs):
-        index = ingestion_index.read_from_chroma()
+    def __init__(self, index=None, **kwargs):
+        if index is None:
+            index = self.load_index()
         self.retriever = index.as_retriever(
             vector_store_query_mode=VectorStoreQueryMode.HYBRID, **kwargs
         )
+        self.collection = index.vector_store.client
+        # Same shared model the index was loaded with.
+        self.embed_model = get_embed_model(self.get_embedding_model_name())
+        self.similarity_top_k = kwargs.get("similarity_top_k", DEFAULT_SIMILARITY_TOP_K)
 
-    def search(self, queries: list[str]):
-        # create set formatted_response
-        documentIdSet = set()
-        formatted_response = []
+    @staticmethod
+    def load_index():
+        return ingestion_index.read_from_chroma()
 
-        for q in queries:
-            response: List[NodeWithScore] = self.retriever.retrieve(q)
-            print(f"chroma_retrieval | query {q} | response {response}")
-            response = Reranker().get_top_k(q, response, k=5)
-            processor = MetadataReplacementPostProcessor(target_metadata_key="window")
-            response = processor.postprocess_nodes(response)
+    @staticmethod
+    def get_embedding_model_name() -> str:
+        return ingestion_index.embedding_model_name
 
-            # print(f"chroma_retrieval | query {q} | response {response}")
+    def batch_retrieve(self, queries: list[str]) -> List[List[NodeWithScore]]:
+        # Same results as calling self.retriever.retrieve(q) for each query, but with
+        # one embedding call and one Chroma query for all of them.
+        if len(queries) == 0:
+            return []
+
+        query_embeddings = get_query_embedding_batch(self.embed_model, queries)
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=self.similarity_top_k,
+        )
 
-            for x in response:
-                if x.node_id not in documentIdSet:
-                    documentIdSet.add(x.node_id)
-                    source = Source(
+        responses = []
+        for i in range(len(queries)):
+            response = []
+            for node_id, text, metadata, distance in zip(
+                results["ids"][i],
+                results["documents"][i],
+                results["metadatas"][i],
+                results["distances"][i],
+            ):
+                response.append(
+                    NodeWithScore(
+                        node=self._to_node(node_id, text, metadata),
+                        score=math.exp(-distance),
+                    )
+                )
+            responses.append(response)
+        return responses
+
+    def get_sentence_nodes(self, document_ids: list[str]) -> list[TextNode]:
+        """Every stored sentence node of the given documents, with its embedding."""
+        if len(document_ids) == 0:
+            return []
+        results = self.collection.get(
+            where={"document_id": {"$in": list(set(document_ids))}},
+            include=["documents", "embeddings", "metadatas"],
+        )
+        nodes = []
+        for node_id, text, metadata, embedding in zip(
+            results["ids"],
+            results["documents"],
+            results["metadatas"],
+            results["embeddings"],
+        ):
+            node = self._to_node(node_id, text, metadata)
+            node.embedding = list(embedding)
+            nodes.append(node)
+        return nodes
+
+    @staticmethod
+    def _to_node(node_id: str, text: str, metadata: dict) -> TextNode:
+        # Mirrors ChromaVectorStore.query
+        try:
+            node = metadata_dict_to_node(metadata)
+            node.set_content(text)
+        except Exception:
+            metadata, node_info, relationships = legacy_metadata_dict_to_node(metadata)
+            node = TextNode(
+                text=text,
+                id_=node_id,
+                metadata=metadata,
+                start_char_idx=node_info.get("start", None),
+                end_char_idx=node_info.get("end", None),
+                relationships=relationships,
+            )
+        return node
+
+    def search(self, queries: list[str], weights: list[float] | None = None):
+        responses = self.batch_retrieve(queries)
+        # Rerank the candidates of every query in a single batched pass
+        responses = get_reranker().get_top_k_many(queries, responses, k=5)
+        processor = MetadataReplacementPostProcessor(target_metadata_key="window")
+        results_per_query: list[list[Source]] = []
+
+        for q, response in zip(queries, responses):
+            logger.debug(f"chroma_retrieval | query {q} | response {response}")
+            response = processor.postprocess_nodes(response)
+
+            results_per_query.append(
+                [
+                    Source(
                         id=x.node_id,
                         doi=x.metadata.get("doi", ""),
                         file_name=x.metadata.get("file_name", ""),
                         page=x.metadata.get("page", 1),
                         content=x.get_content(),
                         score=round(x.get_score(), 2),
+                        document_id=x.node.ref_doc_id or "",
+                        window_start=x.metadata.get(WINDOW_START_KEY),
+                        window_end=x.metadata.get(WINDOW_END_KEY),
                     )
-                    formatted_response.append(source)
-                else:
-                    # search the document in formatted_response and update the score with greates
-                    for doc in formatted_response:
-                        if doc.id == x.node_id:
-                            doc.score = max(doc.score, round(x.get_score(), 2))
-                            break
-        # logger.info(json.dumps(formatted_response, indent=4, default=str))
-        return formatted_response
+                    for x in response
+                ]
+            )
+
+        # Merge duplicated chunks across queries by node id
+        return fuse_results(results_per_query, weights=weights)
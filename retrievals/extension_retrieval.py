@@ -5,6 +5,7 @@ from llama_index.core.vector_stores.types import (
 from ingestion.ingestionn import ingestion_index
 from models.types import Source
 from preretrieve.expansion.langchain.expansion import QueryExpansion
+from retrievals.fusion import fuse_results
 from retrievals.retrieval import Retrieval
 
 
@@ -20,33 +21,27 @@ class ExtensionRetrievalApi:
             **kwargs,
         )
 
-    def search(self, queries):
-        # create set formatted_response
-        documentIdSet = set()
-        formatted_response = []
+    def search(self, queries, weights: list[float] | None = None):
+        results_per_query: list[list[Source]] = []
 
         for q in queries:
             response = self.retriever.retrieve(q)
 
-            for x in response:
-                if x.node_id not in documentIdSet:
-                    documentIdSet.add(x.node_id)
-                    source = Source(
+            results_per_query.append(
+                [
+                    Source(
                         id=x.node_id,
                         doi=x.metadata.get("doi", ""),
                         file_name=x.metadata.get("file_name", ""),
                         content=x.get_content(),
                         score=round(x.get_score(), 2),
                     )
-                    formatted_response.append(source)
-                else:
-                    # search the document in formatted_response and update the score with greates
-                    for doc in formatted_response:
-                        if doc.id == x.node_id:
-                            doc.score = max(doc.score, round(x.get_score(), 2))
-                            break
-        # logger.info(json.dumps(formatted_response, indent=4, default=str))
-        return formatted_response
+                    for x in response
+                ]
+            )
+
+        # Merge duplicated chunks across queries by node id
+        return fuse_results(results_per_query, weights=weights)
 
     def search_v0(self, query):
         response = self.retriever.retrieve(query)
@@ -5,7 +5,9 @@ from llama_index.core.schema import NodeWithScore
 
 # from ingestion.ingestionn import ingestion_index
 from models.types import Source
-from postretrieve.rerank import Reranker
+from postretrieve.rerank import get_reranker
+from postretrieve.window_merge import WINDOW_END_KEY, WINDOW_START_KEY
+from retrievals.fusion import fuse_results
 from retrievals.retrieval import Retrieval
 from llama_index.core.vector_stores.types import (
     VectorStoreQueryMode,
@@ -22,38 +24,47 @@ logger = logging.getLogger(__name__)
 class FaissRetrievalApi:
     # Retrieve using deep models.
 
-    def __init__(self, **kwargs):
-        index = faiss_instance.load_index()
+    def __init__(self, index=None, **kwargs):
+        if index is None:
+            index = self.load_index()
         self.retriever = index.as_retriever()
 
-    def search(self, queries: list[str]):
-        # create set formatted_response
-        documentIdSet = set()
-        formatted_response = []
+    @staticmethod
+    def load_index():
+        return faiss_instance.load_index()
 
-        for q in queries:
-            response: List[NodeWithScore] = self.retriever.retrieve(q)
-            response = Reranker().get_top_k(q, response, k=5)
-            processor = MetadataReplacementPostProcessor(target_metadata_key="window")
+    @staticmethod
+    def get_embedding_model_name() -> str:
+        return faiss_instance.embedding_model_name
+
+    def search(self, queries: list[str], weights: list[float] | None = None):
+        responses: List[List[NodeWithScore]] = [
+            self.retriever.retrieve(q) for q in queries
+        ]
+        # Rerank the candidates of every query in a single batched pass
+        responses = get_reranker().get_top_k_many(queries, responses, k=5)
+        processor = MetadataReplacementPostProcessor(target_metadata_key="window")
+        results_per_query: list[list[Source]] = []
+
+        for response in responses:
             response = processor.postprocess_nodes(response)
 
-            for x in response:
-                if x.node_id not in documentIdSet:
-                    documentIdSet.add(x.node_id)
-                    source = Source(
+            results_per_query.append(
+                [
+                    Source(
                         id=x.node_id,
                         doi=x.metadata.get("doi", ""),
                         file_name=x.metadata.get("file_name", ""),
                         page=x.metadata.get("page", ""),
                         content=x.get_content(),
                         score=round(x.get_score(), 2),
+                        document_id=x.node.ref_doc_id or "",
+                        window_start=x.metadata.get(WINDOW_START_KEY),
+                        window_end=x.metadata.get(WINDOW_END_KEY),
                     )
-                    formatted_response.append(source)
-                else:
-                    # search the document in formatted_response and update the score with greates
-                    for doc in formatted_response:
-                        if doc.id == x.node_id:
-                            doc.score = max(doc.score, round(x.get_score(), 2))
-                            break
-        # logger.info(json.dumps(formatted_response, indent=4, default=str))
-        return formatted_response
+                    for x in response
+                ]
+            )
+
+        # Merge duplicated chunks across queries by node id
+        return fuse_results(results_per_query, weights=weights)
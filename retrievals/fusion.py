@@ -0,0 +1,75 @@
+import os
+from enum import Enum
+
+import numpy as np
+
+from models.types import Source
+
+
+class FusionMethod(str, Enum):
+    MAX = "max"
+    SUM = "sum"
+    RRF = "rrf"
+
+
+FUSION_METHOD = FusionMethod(os.getenv("RETRIEVAL_FUSION", FusionMethod.MAX))
+
+# Constant from the original Reciprocal Rank Fusion paper (Cormack et al., 2009).
+RRF_K = 60
+
+
+def fuse_results(
+    results_per_query: list[list[Source]],
+    method: FusionMethod = FUSION_METHOD,
+    weights: list[float] | None = None,
+    rrf_k: int = RRF_K,
+) -> list[Source]:
+    """Merge the results of several queries into one list sorted by fused score.
+
+    Duplicates are found through a dict keyed by source id, and the scores of
+    every (source, query) hit are combined with NumPy:
+    - max: highest weighted score of the source across queries.
+    - sum: sum of the weighted scores.
+    - rrf: sum of weight / (rrf_k + rank) over the queries returning the source.
+    """
+    if weights is None:
+        weights = [1.0] * len(results_per_query)
+    if len(weights) != len(results_per_query):
+        raise ValueError(
+            f"Expected {len(results_per_query)} weights, got {len(weights)}"
+        )
+
+    positions: dict[str, int] = {}
+    sources: list[Source] = []
+    rows, cols, values = [], [], []
+    for query_idx, results in enumerate(results_per_query):
+        for rank, source in enumerate(results, start=1):
+            position = positions.get(source.id)
+            if position is None:
+                position = positions[source.id] = len(sources)
+                sources.append(source)
+
+            rows.append(position)
+            cols.append(query_idx)
+            values.append(
+                1.0 / (rrf_k + rank) if method == FusionMethod.RRF else source.score
+            )
+
+    if len(sources) == 0:
+        return []
+
+    rows = np.asarray(rows)
+    weighted = np.asarray(values) * np.asarray(weights, dtype=float)[cols]
+    if method == FusionMethod.MAX:
+        fused = np.full(len(sources), -np.inf)
+        np.maximum.at(fused, rows, weighted)
+    else:
+        fused = np.zeros(len(sources))
+        np.add.at(fused, rows, weighted)
+
+    # Stable sort keeps first-seen order between equal scores.
+    order = np.argsort(-fused, kind="stable")
+    return [
+        sources[i].model_copy(update={"score": round(float(fused[i]), 4)})
+        for i in order
+    ]
@@ -10,16 +10,23 @@ logger = logging.getLogger(__name__)
 
 @Retrieval.register
 class GraphRetrievalApi:
-    def __init__(self, **kwargs):
-        graph_ingestion = GraphIngestion()
-        graph_ingestion.init_graph_db()
-        index = graph_ingestion.get_latest_index(
+    def __init__(self, index=None, **kwargs):
+        if index is None:
+            index = self.load_index()
+        self.retriever = index.as_retriever(**kwargs)
+
+    @staticmethod
+    def load_index():
+        return GraphIngestion().get_latest_index(
             username="neo4j",
             password="yasuotruong",
             database="neo4j",
             url="neo4j://localhost:7687",
         )
-        self.retriever = index.as_retriever(**kwargs)
+
+    @staticmethod
+    def get_embedding_model_name() -> str:
+        return GraphIngestion.DEFAULT_EMBEDDING_MODEL_NAME
 
     def search(self, queries: list[str] = []):
         response = self.retriever.retrieve(queries[0])
@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from retrievals.retrieval import Retrieval
+
+logger = logging.getLogger(__name__)
+
+# Entries that have not served a request for this many seconds are dropped.
+RETRIEVER_IDLE_TTL = float(os.getenv("RETRIEVER_IDLE_TTL", 30 * 60))
+
+
+@dataclass
+class _PoolEntry:
+    retrieval: Retrieval
+    handle_key: tuple
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class RetrieverPool:
+    """Long-lived retrieval backends shared by every Streamlit session.
+
+    Backend handles (Chroma client, FAISS index + docstore, Neo4j connection) are
+    loaded once per (backend, embedding model). Retrievers are cheap views over a
+    handle, cached per (backend, alpha, similarity_top_k, embedding model).
+    """
+
+    def __init__(self, idle_ttl: float = RETRIEVER_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._entries: dict[tuple, _PoolEntry] = {}
+        self._handles: dict[tuple, Any] = {}
+        self._handle_locks: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, backend: str, retrieval_cls, **kwargs) -> Retrieval:
+        embedding_model_name = retrieval_cls.get_embedding_model_name()
+        key = (
+            backend,
+            kwargs.get("alpha"),
+            kwargs.get("similarity_top_k"),
+            embedding_model_name,
+        )
+        handle_key = (backend, embedding_model_name)
+
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = time.monotonic()
+                return entry.retrieval
+            handle_lock = self._handle_locks.setdefault(handle_key, threading.Lock())
+
+        # Load outside the pool lock so other backends stay available meanwhile.
+        with handle_lock:
+            handle = self._handles.get(handle_key)
+            if handle is None:
+                logger.info(f"Loading retrieval backend {handle_key}")
+                handle = retrieval_cls.load_index()
+
+            retrieval = retrieval_cls(index=handle, **kwargs)
+            with self._lock:
+                self._handles[handle_key] = handle
+                entry = self._entries.setdefault(
+                    key, _PoolEntry(retrieval=retrieval, handle_key=handle_key)
+                )
+                entry.last_used = time.monotonic()
+                return entry.retrieval
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._handles.clear()
+
+    def _evict_idle(self):
+        # Caller must hold self._lock
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self.idle_ttl:
+                logger.info(f"Evicting idle retriever {key}")
+                del self._entries[key]
+
+        # Drop backend handles that no retriever uses anymore.
+        in_use = {entry.handle_key for entry in self._entries.values()}
+        for handle_key in list(self._handles):
+            if handle_key not in in_use:
+                del self._handles[handle_key]
+
+
+retriever_pool = RetrieverPool()
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use only, see "Import time" in the README.
+HEAVY_MODULES = ["torch", "sentence_transformers", "chromadb", "neo4j"]
+
+
+def test_app_modules_do_not_import_heavy_backends():
+    # A fresh interpreter, so nothing imported by other tests hides a regression.
+    code = (
+        "import json, sys\n"
+        "import models.enum, postretrieve.rerank, retrievals.faiss_retrieval\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == []
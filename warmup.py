@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Backends to preload, comma separated RetrievalApiEnum names.
+WARMUP_RETRIEVALS = os.getenv("WARMUP_RETRIEVALS", "CHROMA_RETRIEVAL")
+# Port of the readiness endpoint, 0 disables it.
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", 8502))
+# Chat models whose tokenizers are preloaded, comma separated, default the
+# sidebar's first model.
+WARMUP_MODELS = os.getenv("WARMUP_MODELS", "")
+
+
+class WarmUpStatus:
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class WarmUp:
+    """Preloads models and backend handles in a background thread.
+
+    Loads the reranker, the chat model tokenizers, the query embedder and the
+    retrieval handles, and runs a dummy query through each so torch allocations
+    and kernels are set up before the first user arrives. `ready` is set once everything succeeded; the health
+    endpoint answers 503 until then so the load balancer holds traffic.
+    """
+
+    def __init__(
+        self, retrieval_types: list[str], model_names: list[str] | None = None
+    ):
+        self.retrieval_types = retrieval_types
+        self.model_names = model_names or []
+        self.ready = threading.Event()
+        self.status = WarmUpStatus.WARMING
+        self.errors: list[str] = []
+        self.seconds = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        self._step("reranker", self._warm_up_reranker)
+        for model_name in self.model_names:
+            self._step(f"{model_name} tokenizer", self._warm_up_tokenizer, model_name)
+        for retrieval_type in self.retrieval_types:
+            self._step(retrieval_type, self._warm_up_retrieval, retrieval_type)
+        self.seconds = round(time.perf_counter() - start, 2)
+
+        if len(self.errors) > 0:
+            self.status = WarmUpStatus.FAILED
+            logger.error(f"Warm-up failed after {self.seconds}s: {self.errors}")
+            return
+        self.status = WarmUpStatus.READY
+        self.ready.set()
+        logger.info(f"Warm-up done in {self.seconds}s")
+
+    def _step(self, name: str, warm_up, *args):
+        start = time.perf_counter()
+        try:
+            warm_up(*args)
+        except Exception as e:
+            logger.exception(f"Warm-up of {name} failed")
+            self.errors.append(f"{name}: {e}")
+            return
+        logger.info(f"Warmed up {name} in {time.perf_counter() - start:.2f}s")
+
+    @staticmethod
+    def _warm_up_reranker():
+        from postretrieve.rerank import warm_up
+
+        warm_up()
+
+    @staticmethod
+    def _warm_up_tokenizer(model_name: str):
+        from generations.context_packer import get_token_counter
+
+        # Falls back to a character estimate without failing the warm-up.
+        get_token_counter(model_name)
+
+    @staticmethod
+    def _warm_up_retrieval(retrieval_type: str):
+        from models.enum import RetrievalApiEnum
+
+        # Same arguments as the sidebar defaults, so the first chat request is
+        # served by this exact pooled retriever.
+        retrieval = RetrievalApiEnum.get_retrieval(
+            retrieval_type=retrieval_type, alpha=1.0, similarity_top_k=5
+        )
+        # Embeds a query, searches the store and reranks the hits.
+        retrieval.search(["warm up"])
+
+    def to_dict(self) -> dict:
+        from postretrieve.score_cache import score_cache
+
+        return {
+            "status": self.status,
+            "seconds": self.seconds,
+            "errors": self.errors,
+            "rerank_cache": score_cache.stats(),
+            "rerank_cascade": self._cascade_stats(),
+        }
+
+    @staticmethod
+    def _cascade_stats() -> dict | None:
+        import sys
+
+        # Only report on rerankers that exist, never load one for a probe.
+        rerank = sys.modules.get("postretrieve.rerank")
+        if rerank is None:
+            return None
+        return {
+            f"{model_name} ({backend.value})": reranker.cascade.stats()
+            for (model_name, backend), reranker in list(rerank._rerankers.items())
+            if reranker.cascade is not None
+        }
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    warm_up: WarmUp
+
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/health", "/ready"):
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.warm_up.to_dict()).encode()
+        self.send_response(200 if self.warm_up.ready.is_set() else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Load balancer probes would flood the console otherwise.
+        logger.debug(format % args)
+
+
+def serve_health(warm_up: WarmUp, port: int = HEALTH_PORT):
+    handler = type("BoundHealthHandler", (HealthHandler,), {"warm_up": warm_up})
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), handler)
+    except OSError as e:
+        logger.warning(f"Health endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    logger.info(f"Health endpoint on http://0.0.0.0:{port}/health")
+    return server
+
+
+_warm_up: WarmUp | None = None
+_warm_up_lock = threading.Lock()
+
+
+def start_warm_up() -> WarmUp:
+    """Start the warm-up once per process; Streamlit re-runs app.py on every rerun."""
+    global _warm_up
+    with _warm_up_lock:
+        if _warm_up is None:
+            retrieval_types = [
+                name.strip() for name in WARMUP_RETRIEVALS.split(",") if name.strip()
+            ]
+            model_names = [
+                name.strip() for name in WARMUP_MODELS.split(",") if name.strip()
+            ]
+            if len(model_names) == 0:
+                from const import MODELS
+
+                model_names = MODELS[:1]
+            _warm_up = WarmUp(retrieval_types, model_names)
+            if HEALTH_PORT > 0:
+                serve_health(_warm_up, HEALTH_PORT)
+            _warm_up.start()
+        return _warm_up